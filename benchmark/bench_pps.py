@@ -0,0 +1,231 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#     Filename @  bench_pps.py
+#  Description @  Benchmark pps hot paths on synthetic procfs trees
+# *************************************************************
+
+"""
+Benchmark the hot paths of pps against generated fake proc roots
+
+For every size the benchmark reports:
+
+    refresh_us      median latency of Process.update() on one pid
+    refresh_p99_us  99th percentile of the same
+    create_us       median latency of Process(pid), which reads all fields
+    scan_pps        processes per second of a full snapshot()
+    table_pps       processes per second of ProcessTable.scan()
+    parallel_scan_pps processes per second of Scanner().snapshot()
+    snapshot_bytes  memory allocated per process held by a snapshot
+    refresh_reads   procfs files opened per Process.update()
+    smaps_us        median latency of Process.refresh("smaps")
+    scan_reads      procfs files opened per process by snapshot()
+    mem_percent_us  latency of mem_percent()
+    cpu_sample_us   latency of CpuSampler.sample()
+    system_sample_us latency of SystemSampler.sample()
+
+Each procfs file read costs an open, one or two reads and a close, so
+the read counts are a proxy for the number of syscalls of an operation.
+
+Usage:
+
+    python bench_pps.py --sizes 100 1000 10000 50000 --save baseline.json
+    python bench_pps.py --sizes 100 1000 10000 50000 --compare baseline.json
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import pps
+from fakeproc import make_proc_root
+
+
+# Metrics where a bigger value is better, all others are latencies or costs
+HIGHER_IS_BETTER = ("scan_pps", "table_pps", "parallel_scan_pps")
+
+
+class ReadCounter(object):
+    """Count the procfs files opened and directories listed by pps"""
+    def __init__(self):
+        self.reads = 0
+        self.listdirs = 0
+
+    def __enter__(self):
+        self._read = pps._read
+        self._listdir = os.listdir
+
+        def read(path):
+            self.reads += 1
+            return self._read(path)
+
+        def listdir(path):
+            self.listdirs += 1
+            return self._listdir(path)
+
+        pps._read = read
+        os.listdir = listdir
+        return self
+
+    def __exit__(self, *exc_info):
+        pps._read = self._read
+        os.listdir = self._listdir
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_size(root, pids, samples=1000):
+    pps.PROC_ROOT = root
+    result = {}
+    sample = pids[::max(len(pids) // samples, 1)][:samples]
+
+    timings = []
+    procs = []
+    for pid in sample:
+        start = time.perf_counter()
+        procs.append(pps.Process(pid))
+        timings.append(time.perf_counter() - start)
+    result["create_us"] = percentile(timings, 0.5) * 1e6
+
+    timings = []
+    for p in procs:
+        timings.extend(timeit(p.update, 3))
+    result["refresh_us"] = percentile(timings, 0.5) * 1e6
+    result["refresh_p99_us"] = percentile(timings, 0.99) * 1e6
+
+    with ReadCounter() as counter:
+        for p in procs:
+            p.update()
+    result["refresh_reads"] = counter.reads / len(procs)
+
+    timings = []
+    for p in procs:
+        timings.extend(timeit(lambda: p.refresh("smaps"), 3))
+    result["smaps_us"] = percentile(timings, 0.5) * 1e6
+
+    repeat = 3 if len(pids) <= 10000 else 1
+    timings = timeit(pps.snapshot, repeat)
+    result["scan_pps"] = len(pids) / min(timings)
+    timings = timeit(pps.ProcessTable.scan, repeat)
+    result["table_pps"] = len(pids) / min(timings)
+    with pps.Scanner() as scanner:
+        timings = timeit(scanner.snapshot, repeat)
+    result["parallel_scan_pps"] = len(pids) / min(timings)
+
+    with ReadCounter() as counter:
+        pps.snapshot()
+    result["scan_reads"] = (counter.reads + counter.listdirs) / len(pids)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    snap = pps.snapshot()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    result["snapshot_bytes"] = (after - before) / len(snap)
+    del snap
+
+    result["mem_percent_us"] = percentile(timeit(pps.mem_percent, 200), 0.5) * 1e6
+    sampler = pps.CpuSampler()
+    result["cpu_sample_us"] = percentile(timeit(sampler.sample, 200), 0.5) * 1e6
+    with pps.SystemSampler() as sampler:
+        result["system_sample_us"] = percentile(timeit(sampler.sample, 200), 0.5) * 1e6
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Print the ratio of each metric to its baseline, return the regressions"""
+    regressions = []
+    for size, metrics in sorted(results.items(), key=lambda x: int(x[0])):
+        base = baseline.get(size)
+        if not base:
+            continue
+        for name, value in sorted(metrics.items()):
+            if not base.get(name):
+                continue
+            ratio = value / base[name]
+            if name in HIGHER_IS_BETTER:
+                worse = ratio < 1 / tolerance
+            else:
+                worse = ratio > tolerance
+            print("%8s %-16s %12.2f %12.2f %7.2fx%s" % (
+                size, name, base[name], value, ratio, "  REGRESSION" if worse else ""))
+            if worse:
+                regressions.append((size, name))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark pps on synthetic procfs trees")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[100, 1000, 10000, 50000],
+                        help="Number of processes of each fake proc root")
+    parser.add_argument("--root-dir", type=str, default=None,
+                        help="Keep the generated proc roots in this directory "
+                             "and reuse them in later runs")
+    parser.add_argument("--save", type=str, default=None,
+                        help="Save the results as a baseline to this file")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Compare the results with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Ratio to the baseline reported as a regression")
+    options = parser.parse_args()
+
+    root_dir = options.root_dir or tempfile.mkdtemp(prefix="pps-bench-")
+    results = {}
+    try:
+        for size in options.sizes:
+            root = os.path.join(root_dir, "proc-%d" % size)
+            pidfile = os.path.join(root_dir, "proc-%d.pids" % size)
+            if os.path.isfile(pidfile):
+                with open(pidfile) as f:
+                    pids = json.load(f)
+            else:
+                start = time.time()
+                pids = make_proc_root(root, size)
+                with open(pidfile, "w") as f:
+                    json.dump(pids, f)
+                print("generated %d processes in %.1fs" % (size, time.time() - start))
+
+            results[str(size)] = bench_size(root, pids)
+            print("%8d %s" % (size, json.dumps(results[str(size)], sort_keys=True)))
+    finally:
+        pps.PROC_ROOT = "/proc"
+        if options.root_dir is None:
+            shutil.rmtree(root_dir)
+
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+
+
+# Script starts from here
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#     Filename @  fakeproc.py
+#  Description @  Generate a synthetic procfs tree for pps
+# *************************************************************
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import random
+
+
+__all__ = ["make_proc_root"]
+
+CLK_TCK = 100
+BTIME = 1468800000
+MEMTOTAL = 16 * 1024 * 1024  # kB
+NCPU = 4
+UIDS = [0, 0, 0, 33, 1000, 1001, 65534]
+COMMS = ["nginx", "python", "postgres", "java", "bash", "sshd", "redis-server",
+         "kworker/0:1", "cron", "node"]
+
+_stat_template = (
+    "{pid} ({comm}) {state} {ppid} {pgrp} {session} {tty_nr} {tpgid} 4194560 "
+    "{minflt} 0 {majflt} 0 {utime} {stime} 0 0 20 {nice} {threads} 0 "
+    "{starttime} {vsize} {rss} 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 "
+    "17 {cpu} 0 0 0 0 0\n"
+)
+
+_status_template = (
+    "Name:\t{comm}\n"
+    "Umask:\t0022\n"
+    "State:\t{state} (sleeping)\n"
+    "Tgid:\t{pid}\n"
+    "Pid:\t{pid}\n"
+    "PPid:\t{ppid}\n"
+    "Uid:\t{uid}\t{uid}\t{uid}\t{uid}\n"
+    "Gid:\t{uid}\t{uid}\t{uid}\t{uid}\n"
+    "VmPeak:\t{vsz} kB\n"
+    "VmSize:\t{vsz} kB\n"
+    "VmLck:\t0 kB\n"
+    "VmRSS:\t{rss_kb} kB\n"
+    "VmSwap:\t0 kB\n"
+    "Threads:\t{threads}\n"
+    "voluntary_ctxt_switches:\t{vcs}\n"
+    "nonvoluntary_ctxt_switches:\t{nvcs}\n"
+)
+
+_io_template = (
+    "rchar: {rchar}\n"
+    "wchar: {wchar}\n"
+    "syscr: {syscr}\n"
+    "syscw: {syscw}\n"
+    "read_bytes: {read_bytes}\n"
+    "write_bytes: {write_bytes}\n"
+    "cancelled_write_bytes: 0\n"
+)
+
+
+def _write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _write_system(root, nprocs, uptime):
+    cpu = "cpu  %d 0 %d %d 100 0 10 5 0 0\n"
+    lines = [cpu % (uptime * 30 * NCPU, uptime * 10 * NCPU, uptime * 60 * NCPU)]
+    for i in range(NCPU):
+        lines.append("cpu%d %d 0 %d %d 25 0 2 1 0 0\n"
+                     % (i, uptime * 30, uptime * 10, uptime * 60))
+    lines.append("intr 0\nctxt 0\nbtime %d\nprocesses %d\n" % (BTIME, nprocs))
+    lines.append("procs_running 1\nprocs_blocked 0\n")
+    _write(os.path.join(root, "stat"), "".join(lines))
+
+    _write(os.path.join(root, "meminfo"),
+           "MemTotal:       %d kB\n"
+           "MemFree:        %d kB\n"
+           "MemAvailable:   %d kB\n"
+           "Buffers:        %d kB\n"
+           "Cached:         %d kB\n"
+           "SwapTotal:      0 kB\n"
+           "SwapFree:       0 kB\n"
+           % (MEMTOTAL, MEMTOTAL // 4, MEMTOTAL // 2, MEMTOTAL // 32, MEMTOTAL // 8))
+    _write(os.path.join(root, "uptime"), "%d.00 %d.00\n" % (uptime, uptime * NCPU // 2))
+    _write(os.path.join(root, "loadavg"), "1.00 0.50 0.25 1/%d %d\n" % (nprocs, nprocs))
+
+    pressure = os.path.join(root, "pressure")
+    if not os.path.isdir(pressure):
+        os.mkdir(pressure)
+    for name in ("cpu", "memory", "io"):
+        _write(os.path.join(pressure, name),
+               "some avg10=1.50 avg60=1.00 avg300=0.50 total=123456\n"
+               "full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n")
+
+
+def make_proc_root(root, nprocs, seed=0, uptime=86400):
+    """
+    Write a fake procfs tree with nprocs processes below root and return
+    the list of their pids. Point pps at it with 'pps.PROC_ROOT = root'.
+
+    Pid 1 is the root of the process tree, every other process is a child
+    of a random earlier one. Each process has stat, status, statm, io,
+    cmdline and smaps_rollup files, and a task directory with its main
+    thread.
+    """
+    rand = random.Random(seed)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    _write_system(root, nprocs, uptime)
+
+    pids = []
+    pid = 0
+    for i in range(nprocs):
+        pid = pid + rand.randint(1, 3) if pids else 1
+        ppid = rand.choice(pids) if pids else 0
+        pids.append(pid)
+
+        comm = rand.choice(COMMS)
+        rss = rand.randint(0, 65536)  # pages
+        vsize = (rss + rand.randint(0, 262144)) * 4096
+        values = {
+            "pid": pid, "ppid": ppid, "comm": comm, "uid": rand.choice(UIDS),
+            "state": rand.choice("SSSSSRD"), "pgrp": pid, "session": pid,
+            "tty_nr": 0, "tpgid": -1, "nice": 0,
+            "threads": rand.choice([1, 1, 1, 2, 8]),
+            "minflt": rand.randint(0, 100000), "majflt": rand.randint(0, 100),
+            "utime": rand.randint(0, 100000), "stime": rand.randint(0, 20000),
+            "starttime": rand.randint(0, uptime * CLK_TCK),
+            "vsize": vsize, "vsz": vsize // 1024, "rss": rss, "rss_kb": rss * 4,
+            "cpu": rand.randint(0, NCPU - 1),
+            "vcs": rand.randint(0, 100000), "nvcs": rand.randint(0, 1000),
+            "rchar": rand.randint(0, 10 ** 9), "wchar": rand.randint(0, 10 ** 9),
+            "syscr": rand.randint(0, 10 ** 6), "syscw": rand.randint(0, 10 ** 6),
+            "read_bytes": rand.randint(0, 10 ** 9),
+            "write_bytes": rand.randint(0, 10 ** 9),
+        }
+
+        piddir = os.path.join(root, str(pid))
+        os.mkdir(piddir)
+        stat = _stat_template.format(**values)
+        status = _status_template.format(**values)
+        _write(os.path.join(piddir, "stat"), stat)
+        _write(os.path.join(piddir, "status"), status)
+        _write(os.path.join(piddir, "statm"), "%d %d 0 1 0 %d 0\n"
+               % (vsize // 4096, rss, rss))
+        _write(os.path.join(piddir, "io"), _io_template.format(**values))
+        _write(os.path.join(piddir, "cmdline"),
+               "\0".join(["/usr/bin/" + comm, "--worker", str(i)]) + "\0")
+        _write(os.path.join(piddir, "smaps_rollup"),
+               "00400000-7fffffffffff ---p 00000000 00:00 0    [rollup]\n"
+               "Rss:            %d kB\n"
+               "Pss:            %d kB\n"
+               "Shared_Clean:   %d kB\n"
+               "Shared_Dirty:   0 kB\n"
+               "Private_Clean:  0 kB\n"
+               "Private_Dirty:  %d kB\n"
+               "Swap:           0 kB\n"
+               "SwapPss:        0 kB\n"
+               % (rss * 4, rss * 3, rss * 2, rss * 2))
+
+        taskdir = os.path.join(piddir, "task", str(pid))
+        os.makedirs(taskdir)
+        _write(os.path.join(taskdir, "stat"), stat)
+        _write(os.path.join(taskdir, "status"), status)
+
+    return pids
@@ -0,0 +1,223 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *************************************************************
+#     Filename @  notify.py
+#  Description @  Asynchronous alert dispatch for watchpmc
+# *************************************************************
+
+"""
+Alerts are queued by Notifier.notify(), which never blocks, and sent by a
+background thread. The thread collects the alerts of a window into one
+batch, alerts with the same key in a window are coalesced into one entry
+with a count, and every sink gets the batch with retries and exponential
+backoff. A sink is a callable taking the batch, a list of Alert, and
+raising on failure.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import json
+import time
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+__all__ = ["Alert", "Notifier", "SMTPSink", "FileSink", "WebhookSink", "MemorySink"]
+
+log = logging
+
+# count is the number of alerts coalesced into this one, time is the
+# time of the first of them
+Alert = namedtuple("Alert", ["key", "subject", "body", "time", "count"])
+
+
+class Notifier(object):
+    """
+    Send alerts to sinks from a background thread
+
+    At most maxsize alerts wait in the queue, notify() drops the alert and
+    returns False when it is full. A batch is sent window seconds after
+    its first alert arrived, each sink is tried 1 + retries times, waiting
+    backoff, 2 * backoff, ... seconds between tries.
+    """
+    def __init__(self, sinks, window=10, maxsize=1000, retries=3, backoff=1):
+        self.sinks     = list(sinks)
+        self.window    = window
+        self.retries   = retries
+        self.backoff   = backoff
+        self.sent      = 0
+        self.failed    = 0
+        self.dropped   = 0
+        self.coalesced = 0
+        self._queue    = queue.Queue(maxsize)
+        self._closed   = threading.Event()
+        self._thread   = threading.Thread(target=self._run, name="notifier")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def notify(self, key, subject, body):
+        """Queue an alert without blocking, return False if it was dropped"""
+        try:
+            self._queue.put_nowait(Alert(key, subject, body, time.time(), 1))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            log.error("alert queue is full, drop alert: %s" % subject)
+            return False
+
+    def _collect(self):
+        """Wait for an alert, then return the batch of its window"""
+        while True:
+            try:
+                first = self._queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self._closed.is_set():
+                    return None
+
+        batch = OrderedDict([(first.key, first)])
+        deadline = time.monotonic() + self.window
+        while True:
+            timeout = 0 if self._closed.is_set() else max(deadline - time.monotonic(), 0)
+            try:
+                alert = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            previous = batch.get(alert.key)
+            if previous is None:
+                batch[alert.key] = alert
+            else:
+                batch[alert.key] = previous._replace(body=alert.body,
+                                                     count=previous.count + 1)
+                self.coalesced += 1
+        return list(batch.values())
+
+    def _send(self, sink, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                sink(batch)
+                return True
+            except Exception as err:
+                log.error("alert sink %r failed (attempt %d): %s" % (sink, attempt + 1, err))
+            if attempt < self.retries:
+                # Returns at once when closing, the retries are not delayed
+                self._closed.wait(self.backoff * 2 ** attempt)
+        return False
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            for sink in self.sinks:
+                if self._send(sink, batch):
+                    self.sent += len(batch)
+                else:
+                    self.failed += len(batch)
+
+    def close(self, timeout=None):
+        """Send the queued alerts without waiting for their window and stop"""
+        self._closed.set()
+        self._thread.join(timeout)
+
+
+def _text(batch):
+    lines = []
+    for alert in batch:
+        lines.append(alert.body if alert.count == 1 else
+                     "%s\n(%d alerts coalesced)" % (alert.body, alert.count))
+    return "\n\n".join(lines)
+
+
+def _subject(batch):
+    if len(batch) == 1:
+        return batch[0].subject
+    return "%s (+%d more)" % (batch[0].subject, len(batch) - 1)
+
+
+class SMTPSink(object):
+    """Send a batch as one email through an SMTP server"""
+    def __init__(self, host, sender, to, user=None, password=None, port=0,
+                 ssl=False, subtype="html", timeout=10):
+        self.host     = host
+        self.port     = port
+        self.sender   = sender
+        self.to       = list(to)
+        self.user     = user
+        self.password = password
+        self.ssl      = ssl
+        self.subtype  = subtype
+        self.timeout  = timeout
+
+    def __call__(self, batch):
+        import smtplib
+        from email.mime.text import MIMEText
+        msg = MIMEText(_text(batch), self.subtype, "utf-8")
+        msg["Subject"] = _subject(batch)
+        msg["From"] = self.sender
+        msg["To"] = ", ".join(self.to)
+        smtp = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
+        with smtp(self.host, self.port, timeout=self.timeout) as server:
+            if self.user:
+                server.login(self.user, self.password)
+            server.sendmail(self.sender, self.to, msg.as_string())
+
+    def __repr__(self):
+        return "SMTPSink(%s)" % self.host
+
+
+class FileSink(object):
+    """Append a batch to a file as one JSON object per alert"""
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, batch):
+        with open(self.path, "a") as f:
+            for alert in batch:
+                f.write(json.dumps(alert._asdict(), default=str) + "\n")
+
+    def __repr__(self):
+        return "FileSink(%s)" % self.path
+
+
+class WebhookSink(object):
+    """POST a batch as a JSON list of alerts to url"""
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, batch):
+        from urllib.request import Request, urlopen
+        data = json.dumps([alert._asdict() for alert in batch], default=str)
+        request = Request(self.url, data.encode("utf-8"),
+                          {"Content-Type": "application/json"})
+        urlopen(request, timeout=self.timeout).close()
+
+    def __repr__(self):
+        return "WebhookSink(%s)" % self.url
+
+
+class MemorySink(object):
+    """
+    Keep the batches in memory, a local stand-in for the real sinks in
+    tests. The first fail calls raise to exercise the retries.
+    """
+    def __init__(self, fail=0):
+        self.batches = []
+        self.calls = 0
+        self.fail = fail
+
+    def __call__(self, batch):
+        self.calls += 1
+        if self.calls <= self.fail:
+            raise IOError("MemorySink failure %d" % self.calls)
+        self.batches.append(batch)
+
+    def __repr__(self):
+        return "MemorySink()"
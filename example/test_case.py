@@ -42,3 +42,71 @@ def test_watchpmc():
     consume.join()
     test_p1.join()
     test_p2.join()
+
+def test_control_server(tmpdir):
+    conf = tmpdir.join("watchpmc.conf")
+    conf.write("[PID_LIST]\nself = %d\n\n[PARAMETERS]\nmem_limit = 70\n" % os.getpid())
+    path = str(tmpdir.join("watchpmc.sock"))
+
+    watcher = make_watcher([os.getpid(), 1], interval=0.01, mem_limit=100, cpu_limit=100)
+    server = ControlServer(path, watcher, str(conf)).start()
+    try:
+        watcher.run(ticks=2)
+        status = control(path, "status")
+        assert status["ok"] and status["ticks"] == 2
+        assert status["limits"] == {"mem_limit": 100, "cpu_limit": 100}
+        assert sorted(p["pid"] for p in status["processes"]) == [1, os.getpid()]
+
+        response = control(path, "reload", remove=[1], cpu_limit=80, interval=2)
+        assert response["removed"] == [1]
+        assert response["limits"]["cpu_limit"] == 80 and watcher.interval == 2
+
+        # An idle client does not block the others
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(path)
+        with idle:
+            response = control(path, "reload", accurate_mem=True, cgroup_mem_limit=80,
+                               timeout=1)
+        assert response["limits"]["cgroup_mem_limit"] == 80
+        assert [rule.accurate for rule in watcher.rules if isinstance(rule, MemRule)] == [True]
+        response = control(path, "reload", cgroup_mem_limit=None)
+        assert "cgroup_mem_limit" not in response["limits"]
+        assert control(path, "reload", mem_limit=None)["ok"] is False
+
+        response = control(path, "reload")
+        assert response["limits"]["mem_limit"] == 70
+        assert list(watcher.processes) == [os.getpid()]
+        assert control(path, "nothing")["ok"] is False
+    finally:
+        server.shutdown()
+    assert not os.path.exists(path)
+
+def test_notifier(tmpdir):
+    from notify import MemorySink
+
+    sink = MemorySink(fail=1)
+    path = str(tmpdir.join("alerts"))
+    notifier = Notifier([sink, FileSink(path)], window=0.2, retries=2, backoff=0.01)
+    for i in range(3):
+        assert notifier.notify(("kill", 1), "kill 1", "body %d" % i)
+    assert notifier.notify(("kill", 2), "kill 2", "body")
+    notifier.close()
+
+    assert sink.calls == 2
+    batch, = sink.batches
+    assert [(a.key, a.count, a.body) for a in batch] == \
+        [(("kill", 1), 3, "body 2"), (("kill", 2), 1, "body")]
+    assert notifier.coalesced == 2 and notifier.sent == 4 and notifier.failed == 0
+    with open(path) as f:
+        assert len(f.readlines()) == 2
+
+def test_notifier_does_not_block():
+    import time
+    blocked = threading.Event()
+    notifier = Notifier([lambda batch: blocked.wait(5)], window=0, maxsize=2)
+    start = time.monotonic()
+    results = [notifier.notify(i, "alert", "body") for i in range(10)]
+    assert time.monotonic() - start < 0.5
+    assert not all(results) and notifier.dropped == results.count(False)
+    blocked.set()
+    notifier.close()
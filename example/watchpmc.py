@@ -12,9 +12,14 @@ from __future__ import absolute_import, print_function, division
 
 import os
 import sys
+import json
+import time
+import socket
 import platform
 import datetime
+import threading
 from time import sleep
+from collections import deque
 from argparse import ArgumentParser
 try:
     from configparser import ConfigParser
@@ -28,8 +33,9 @@ logging.basicConfig(level=logging.INFO,
 log = logging
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from pps import Process, mem_percent, cpu_percent
+from pps import Watcher, MemRule, CpuRule, CgroupRule
 from daemon import Daemon
+from notify import Alert, Notifier, SMTPSink, FileSink, WebhookSink
 
 
 mail_template = \
@@ -46,80 +52,365 @@ Process(%(pid)d) has been killed:
 %(dt)s
 </pre>"""
 
+def smtp_sink(config=None):
+    """SMTP sink of the [NOTIFY] section, the account is read from environment"""
+    get = lambda key, default: (config.get("NOTIFY", key, fallback=default)
+                                if config is not None else default)
+    return SMTPSink(host=get("smtp_host", "smtp.yeah.net"),
+                    port=int(get("smtp_port", 0)),
+                    sender="监听者<%s>" % os.environ["MAIL_ADDR"],
+                    to=get("mail_to", "loveqing2013@foxmail.com").split(","),
+                    user=os.environ["MAIL_ADDR"], password=os.environ["MAIL_PASS"])
+
 def send_email(msg):
-    from mailer import Mailer, Message
-    mail_msg = Message(From="监听者<%s>"%(os.environ["MAIL_ADDR"]),
-                    To=["loveqing2013@foxmail.com"],
-                    charset="utf-8")
-    mail_msg.Subject = "Watchpmc Report"
-    mail_msg.Html = msg
-    sender = Mailer(host="smtp.yeah.net", usr=os.environ["MAIL_ADDR"], pwd=os.environ["MAIL_PASS"])
-    sender.send(mail_msg)
-
-def watchpmc(pid_list, interval=1, mem_limit=50, cpu_limit=50):
-    """Watch mem and cpu used of process"""
-    p_list = []
+    smtp_sink()([Alert(None, "Watchpmc Report", msg, time.time(), 1)])
+
+def make_notifier(config=None):
+    """
+    Notifier of the sinks configured in the [NOTIFY] section: SMTP when
+    MAIL_ADDR is set, a file and a webhook
+    """
+    sinks = []
+    if "MAIL_ADDR" in os.environ:
+        sinks.append(smtp_sink(config))
+    window = 10
+    if config is not None and config.has_section("NOTIFY"):
+        window = config.getfloat("NOTIFY", "window", fallback=window)
+        if config.has_option("NOTIFY", "file"):
+            sinks.append(FileSink(config.get("NOTIFY", "file")))
+        if config.has_option("NOTIFY", "webhook"):
+            sinks.append(WebhookSink(config.get("NOTIFY", "webhook")))
+    return Notifier(sinks, window=window)
+
+# Alerts are sent by the notifier thread, so a slow mail server never
+# delays the watch loop
+notifier = None
+
+# The latest kills, reported by the status command of the control socket
+kill_history = deque(maxlen=100)
+
+# Threads of the kills in progress
+kill_threads = []
+
+def kill_and_report(p, reason):
+    """
+    Kill p in a thread of its own, so the watch loop never waits for a
+    process which ignores SIGTERM
+    """
+    kill_threads[:] = [t for t in kill_threads if t.is_alive()]
+    thread = threading.Thread(target=_kill_and_report, args=(p, reason),
+                              name="kill-%d" % p.pid)
+    thread.start()
+    kill_threads.append(thread)
+
+def wait_kills(timeout=None):
+    for thread in list(kill_threads):
+        thread.join(timeout)
+
+def _kill_and_report(p, reason):
+    elapsed = p.kill()
+    if elapsed is None:
+        log.error("process %d could not be killed" % p.pid)
+    kill_history.append({"time": time.time(), "pid": p.pid, "cmd": p.cmd,
+                         "reason": reason, "elapsed": elapsed})
+    info = p.to_dict()
+    info["dt"] = datetime.datetime.now()
+    info["hostname"] = platform.node()
+    info["system"] = platform.system()
+    info["machine"] = platform.machine()
+    if notifier is not None:
+        notifier.notify(("kill", p.pid), "Watchpmc Report", mail_template % info)
+    log.info("kill: %s, %s" % (repr(p), reason))
+
+def make_watcher(pid_list, interval=1, mem_limit=50, cpu_limit=50,
+                 cgroup_mem_limit=None, cgroup_cpu_limit=None, accurate_mem=False):
+    rules = [MemRule(mem_limit, accurate=accurate_mem), CpuRule(cpu_limit)]
+    if cgroup_mem_limit is not None:
+        rules.append(CgroupRule(cgroup_mem_limit, "memory"))
+    if cgroup_cpu_limit is not None:
+        rules.append(CgroupRule(cgroup_cpu_limit, "cpu"))
+    watcher = Watcher(interval=interval,
+                      rules=rules,
+                      action=kill_and_report,
+                      on_exit=lambda pid: log.error("process %d not found" % pid))
     for pid in pid_list:
         try:
-            p = Process(pid)
-            p_list.append(p)
+            watcher.add(pid)
         except Exception as err:
             log.error(err)
             continue
+    return watcher
 
-    while 1:
-        if len(p_list) == 0:
-            log.info("Have no process need to watch, watch end.")
-            break
+def set_cgroup_limit(watcher, resource, limit):
+    """
+    Set the limit of the CgroupRule of resource, adding the rule if the
+    watcher has none, or remove the rule when limit is None
+    """
+    rules = [rule for rule in watcher.rules
+             if isinstance(rule, CgroupRule) and rule.resource == resource]
+    if limit is None:
+        for rule in rules:
+            watcher.rules.remove(rule)
+    elif rules:
+        for rule in rules:
+            rule.limit = limit
+    else:
+        watcher.rules.append(CgroupRule(limit, resource))
+
+def read_config(conf_file):
+    """Return the pid list and the parameters of a configuration file"""
+    config = ConfigParser()
+    config.read(conf_file)
+    if not config.has_section("PID_LIST"):
+        raise ValueError("Invalid format of configuration file.")
+    pid_list = [pid for _, pid in config.items("PID_LIST")]
+    paras = {}
+    if config.has_section("PARAMETERS"):
+        paras = dict((k, float(v)) for k, v in config.items("PARAMETERS"))
+    return pid_list, paras
+
+
+class ControlServer(object):
+    """
+    UNIX-domain control socket of a running watcher
+
+    A client sends one JSON object per line and gets one JSON object back:
 
-        for p in p_list:
+        {"cmd": "status"}
+            tick latency, watched processes and kill history, all from
+            memory without reading procfs or forking ps
+        {"cmd": "reload"}
+            read the configuration file again and apply its pid list and
+            parameters
+        {"cmd": "reload", "add": [pid], "remove": [pid], "mem_limit": 60,
+         "cpu_limit": 60, "interval": 2, "accurate_mem": true,
+         "cgroup_mem_limit": 80, "cgroup_cpu_limit": null}
+            apply only the given changes, a cgroup limit adds the cgroup
+            rule if there is none and null removes it
+
+    Changes are made under the watcher lock, so they take effect between
+    two ticks and the watcher keeps its state. Each connection is served
+    by a thread of its own and closed after timeout seconds without a
+    request, so an idle client never blocks the others.
+    """
+    def __init__(self, path, watcher, conf_file=None, timeout=5):
+        self.path = path
+        self.watcher = watcher
+        self.conf_file = conf_file
+        self.timeout = timeout
+        self.started = time.time()
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # left by a daemon which did not exit cleanly
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(8)
+        self._thread = threading.Thread(target=self._serve, name="watchpmc-control")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while self._sock is not None:
             try:
-                p.update()
-                total_mem_percent = mem_percent()
-                total_cpu_percent = cpu_percent()
-
-                condition1 = p.mem > mem_limit and total_mem_percent > 90
-                condition2 = p.cpu > cpu_limit and total_cpu_percent > 90
-
-                if condition1 or condition2:
-                    p.kill()
-                    info = p.to_dict()
-                    info["dt"] = datetime.datetime.now()
-                    info["hostname"] = platform.node()
-                    info["system"] = platform.system()
-                    info["machine"] = platform.machine()
-                    mail_msg = mail_template % info
-                    send_email(mail_msg)
-                    log.info("kill: %s" % repr(p))
-                    p_list.remove(p)
-                    continue
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            conn.settimeout(self.timeout)
+            thread = threading.Thread(target=self._serve_conn, args=(conn,),
+                                      name="watchpmc-control-conn")
+            thread.daemon = True
+            thread.start()
+
+    def _serve_conn(self, conn):
+        with conn:
+            try:
+                line = conn.makefile("rb").readline()
+                response = self.handle(json.loads(line.decode("utf-8")))
             except Exception as err:
-                log.error(err)
-                p_list.remove(p)
+                response = {"ok": False, "error": str(err)}
+            try:
+                conn.sendall(json.dumps(response).encode("utf-8") + b"\n")
+            except OSError:
+                pass
+
+    def handle(self, request):
+        cmd = request.get("cmd")
+        if cmd == "status":
+            return self.status()
+        if cmd == "reload":
+            return self.reload(request)
+        return {"ok": False, "error": "unknown command: %s" % cmd}
+
+    def _limits(self):
+        limits = {}
+        for rule in self.watcher.rules:
+            if isinstance(rule, MemRule):
+                limits["mem_limit"] = rule.limit
+            elif isinstance(rule, CpuRule):
+                limits["cpu_limit"] = rule.limit
+            elif isinstance(rule, CgroupRule):
+                limits["cgroup_%s_limit" % rule.resource[:3]] = rule.limit
+        return limits
+
+    def status(self):
+        watcher = self.watcher
+        with watcher.lock:
+            procs = [{"pid": p.pid, "cmd": p.cmd, "cpu": p.cpu_percent(),
+                      "mem": p.mem, "rss": p.rss}
+                     for p in watcher.processes.values()]
+            system = watcher.system
+            status = {
+                "ok": True,
+                "pid": os.getpid(),
+                "uptime": time.time() - self.started,
+                "interval": watcher.interval,
+                "ticks": watcher.ticks,
+                "tick_cost": watcher.tick_cost,
+                "lag": watcher.lag,
+                "max_lag": watcher.max_lag,
+                "limits": self._limits(),
+                "system": system and {"mem_percent": system.mem_percent,
+                                      "cpu_percent": system.cpu_percent},
+                "processes": procs,
+            }
+        status["kills"] = list(kill_history)
+        return status
 
-        sleep(interval)
+    def reload(self, request):
+        add = request.get("add", [])
+        remove = request.get("remove", [])
+        paras = dict((k, None if request[k] is None else float(request[k]))
+                     for k in ("interval", "mem_limit", "cpu_limit", "accurate_mem",
+                               "cgroup_mem_limit", "cgroup_cpu_limit")
+                     if k in request)
+        watcher = self.watcher
+        if "add" not in request and "remove" not in request and not paras:
+            if not self.conf_file:
+                raise ValueError("no configuration file to reload")
+            pid_list, paras = read_config(self.conf_file)
+            wanted = set(int(pid) for pid in pid_list)
+            add = list(wanted)
+            remove = [pid for pid in list(watcher.processes) if pid not in wanted]
+            # The file holds the whole configuration, a cgroup limit it
+            # does not set is turned off
+            paras.setdefault("cgroup_mem_limit", None)
+            paras.setdefault("cgroup_cpu_limit", None)
+        for k in ("interval", "mem_limit", "cpu_limit", "accurate_mem"):
+            if k in paras and paras[k] is None:
+                raise ValueError("%s cannot be null" % k)
 
-def main(conf="/etc/watchpmc.conf"):
+        added, removed, errors = [], [], []
+        with watcher.lock:
+            for pid in remove:
+                if watcher.remove(pid) is not None:
+                    removed.append(int(pid))
+            for pid in add:
+                if int(pid) in watcher.processes:
+                    continue
+                try:
+                    watcher.add(pid)
+                    added.append(int(pid))
+                except Exception as err:
+                    errors.append("%s: %s" % (pid, err))
+            if "interval" in paras:
+                watcher.interval = paras["interval"]
+            for rule in watcher.rules:
+                if isinstance(rule, MemRule):
+                    rule.limit = paras.get("mem_limit", rule.limit)
+                    rule.accurate = bool(paras.get("accurate_mem", rule.accurate))
+                elif isinstance(rule, CpuRule):
+                    rule.limit = paras.get("cpu_limit", rule.limit)
+            for resource in ("memory", "cpu"):
+                key = "cgroup_%s_limit" % resource[:3]
+                if key in paras:
+                    set_cgroup_limit(watcher, resource, paras[key])
+        log.info("reload: added %s, removed %s, parameters %s" % (added, removed, paras))
+        return {"ok": True, "added": added, "removed": removed, "errors": errors,
+                "limits": self._limits(), "interval": watcher.interval}
+
+    def shutdown(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)  # wakes up the accept() of _serve
+            except OSError:
+                pass
+            sock.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def control(path, cmd, timeout=5, **kwargs):
+    """Send a command to the control socket at path, return the response"""
+    request = dict(kwargs, cmd=cmd)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    with sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        return json.loads(sock.makefile("rb").readline().decode("utf-8"))
+
+def watchpmc(pid_list, interval=1, mem_limit=50, cpu_limit=50, control=None,
+             conf_file=None, cgroup_mem_limit=None, cgroup_cpu_limit=None,
+             accurate_mem=False):
+    """
+    Watch mem and cpu used of process. With a control socket path, serve
+    it and keep running when no process is left, since a reload may add
+    some.
+    """
+    watcher = make_watcher(pid_list, interval, mem_limit, cpu_limit,
+                           cgroup_mem_limit, cgroup_cpu_limit, accurate_mem)
+    try:
+        if control is None:
+            watcher.run()
+            wait_kills()
+            log.info("Have no process need to watch, watch end.")
+            return
+
+        server = ControlServer(control, watcher, conf_file).start()
+        try:
+            while True:
+                watcher.run()
+                sleep(watcher.interval)
+        finally:
+            server.shutdown()
+    finally:
+        watcher.close()
+
+async def awatchpmc(pid_list, interval=1, mem_limit=50, cpu_limit=50):
+    """Watch mem and cpu used of process inside an asyncio event loop"""
+    with make_watcher(pid_list, interval, mem_limit, cpu_limit) as watcher:
+        await watcher.arun()
+    log.info("Have no process need to watch, watch end.")
+
+def main(conf="/etc/watchpmc.conf", control=None):
+    global notifier
     conf_file = os.path.abspath(conf)
-    config = ConfigParser()
-    config.read(conf_file)
-    if not config.has_section("PID_LIST"):
-        log.error("Invalid format of configuration file.")
+    try:
+        pid_list, paras = read_config(conf_file)
+    except ValueError as err:
+        log.error(err)
         sys.exit(0)
 
-    pid_list = [pid for _, pid in config.items("PID_LIST")]
-    if len(pid_list) == 0:
+    if len(pid_list) == 0 and control is None:
         log.error("No process is configured.")
         sys.exit(0)
 
-    if config.has_section("PARAMETERS"):
-        paras = dict(config.items("PARAMETERS"))
-        interval = paras.get("interval", 1)
-        mem_limit = paras.get("mem_limit", 50)
-        cpu_limit = paras.get("cpu_limit", 50)
-        watchpmc(pid_list, float(interval), float(mem_limit), float(cpu_limit))
-    else:
-        watchpmc(pid_list)
+    config = ConfigParser()
+    config.read(conf_file)
+    notifier = make_notifier(config)
+    try:
+        watchpmc(pid_list, paras.get("interval", 1), paras.get("mem_limit", 50),
+                 paras.get("cpu_limit", 50), control, conf_file,
+                 paras.get("cgroup_mem_limit"), paras.get("cgroup_cpu_limit"),
+                 bool(paras.get("accurate_mem", 0)))
+    finally:
+        notifier.close()
 
 
 # Script starts from here
@@ -133,7 +424,7 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--daemon",
                         type=str,
                         default=None,
-                        choices=["start", "stop", "restart", "status"],
+                        choices=["start", "stop", "restart", "status", "reload"],
                         help="Daemon mode")
 
     options = parser.parse_args()
@@ -144,17 +435,31 @@ if __name__ == "__main__":
         config.read(conf_file)
         pidfile = "/tmp/watchpmc.pid"
         logfile = "/tmp/watchpmc.log"
+        control_sock = "/tmp/watchpmc.sock"
         if config.has_section("DAEMON_MODE"):
-            pidfile = config.get("DAEMON_MODE", "pidfile", "/tmp/watchpmc.pid")
-            logfile = config.get("DAEMON_MODE", "logfile", "/tmp/watchpmc.log")
+            pidfile = config.get("DAEMON_MODE", "pidfile", fallback=pidfile)
+            logfile = config.get("DAEMON_MODE", "logfile", fallback=logfile)
+            control_sock = config.get("DAEMON_MODE", "control", fallback=control_sock)
+
+        daemon = Daemon(pidfile, target=main, args=(conf_file, control_sock),
+                        logfile=logfile)
 
-        daemon = Daemon(pidfile, target=main, args=(conf_file,), logfile=logfile)
+        def query(cmd):
+            try:
+                print(json.dumps(control(control_sock, cmd), indent=2))
+            except (OSError, ValueError) as err:
+                sys.stderr.write("Failed to query %s: %s\n" % (control_sock, err))
+                if cmd == "status":
+                    daemon.status()
+                else:
+                    sys.exit(1)
 
         {
             'start':   daemon.start,
             'stop':    daemon.stop,
             'restart': daemon.restart,
-            'status':  daemon.status,
+            'status':  lambda: query("status"),
+            'reload':  lambda: query("reload"),
         }.get(options.daemon, lambda: None)()
     else:
         main(conf_file)
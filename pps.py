@@ -8,6 +8,33 @@
 #  Description @  Linux 'ps -aux' command wrapper
 # *************************************************************
 
+import os
+import sys
+import time
+import errno
+import signal
+import threading
+import heapq
+import operator
+from array import array
+from collections import namedtuple, OrderedDict, deque
+
+# numpy is imported by the first ProcessTable, it stays None when it is
+# not installed
+numpy = None
+_numpy_imported = False
+
+
+def _import_numpy():
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        _numpy_imported = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
 
 class UnfoundException(Exception):
     pass
@@ -17,35 +44,811 @@ class CMDOutException(Exception):
     pass
 
 
+# Root of the procfs mount, the native backend reads everything below it
+PROC_ROOT = "/proc"
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Mount point of the cgroup filesystems, the cgroup v2 hierarchy is either
+# mounted there or, on hybrid hosts, at its unified subdirectory
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# Constant values of a procfs root (boot time, total memory) keyed by root
+_proc_consts = {}
+# Whether procfs is mounted at a root, checked once per root
+_procfs_roots = {}
+_usernames = {}
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class _ProcFile(object):
+    """
+    A procfs file kept open and re-read from offset 0 into a reused buffer,
+    procfs regenerates the content on every read at offset 0
+    """
+    __slots__ = ("path", "fd", "buf")
+
+    def __init__(self, path, size=4096):
+        self.path = path
+        self.fd   = os.open(path, os.O_RDONLY)
+        self.buf  = bytearray(size)
+
+    def _fill(self):
+        if hasattr(os, "preadv"):
+            return os.preadv(self.fd, [self.buf], 0)
+        data = os.pread(self.fd, len(self.buf), 0)
+        self.buf[:len(data)] = data
+        return len(data)
+
+    def read(self, stop=None):
+        """
+        Return the content of the file, or only the part of it before the
+        first stop if given
+        """
+        n = self._fill()
+        while n == len(self.buf):
+            self.buf = bytearray(len(self.buf) * 2)
+            n = self._fill()
+        if stop is not None:
+            end = self.buf.find(stop, 0, n)
+            if end >= 0:
+                n = end
+        return bytes(self.buf[:n])
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+
+def _meminfo_value(data, key):
+    """Return the value in kB of key (bytes) in the content of meminfo"""
+    needle = b"\n" + key + b":"
+    if data.startswith(needle[1:]):
+        start = len(needle) - 1
+    else:
+        start = data.find(needle)
+        if start < 0:
+            return None
+        start += len(needle)
+    end = data.find(b"\n", start)
+    return int(data[start:end if end >= 0 else len(data)].split()[0])
+
+
+def _mem_percent(data):
+    """
+    Percentage of memory in use from the content of meminfo, all values
+    of meminfo are in kB
+    """
+    total = _meminfo_value(data, b"MemTotal")
+    available = _meminfo_value(data, b"MemAvailable")
+    if available is None:
+        # Kernels before 3.14 have no MemAvailable
+        available = sum(_meminfo_value(data, key) or 0
+                        for key in (b"MemFree", b"Buffers", b"Cached"))
+    return round((1 - available / total) * 100, 2)
+
+
+def _procfs_available():
+    available = _procfs_roots.get(PROC_ROOT)
+    if available is None:
+        available = _procfs_roots[PROC_ROOT] = os.path.isfile(os.path.join(PROC_ROOT, "stat"))
+    return available
+
+
+def _proc_const(name):
+    consts = _proc_consts.get(PROC_ROOT)
+    if consts is None:
+        consts = {"btime": 0, "memtotal": 0}
+        for line in _read(os.path.join(PROC_ROOT, "stat")).splitlines():
+            if line.startswith(b"btime"):
+                consts["btime"] = int(line.split()[1])
+                break
+        for line in _read(os.path.join(PROC_ROOT, "meminfo")).splitlines():
+            if line.startswith(b"MemTotal:"):
+                consts["memtotal"] = int(line.split()[1])
+                break
+        _proc_consts[PROC_ROOT] = consts
+    return consts[name]
+
+
+def _username(uid):
+    name = _usernames.get(uid)
+    if name is None:
+        import pwd
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = str(uid)
+        _usernames[uid] = name
+    return name
+
+
+def _parse_stat(data):
+    """
+    Split the content of /proc/<pid>/stat into (comm, fields), fields[0]
+    is the state, the command name may contain spaces and parentheses
+    """
+    lpar = data.index(b"(")
+    rpar = data.rindex(b")")
+    comm = data[lpar + 1:rpar].decode("utf-8", "replace")
+    return comm, data[rpar + 2:].split()
+
+
+def _ttyname(tty_nr):
+    major = (tty_nr >> 8) & 0xfff
+    minor = (tty_nr & 0xff) | ((tty_nr >> 12) & 0xfff00)
+    if 136 <= major <= 143:
+        return "pts/%d" % (minor + (major - 136) * 256)
+    if major == 4:
+        return "tty%d" % minor if minor < 64 else "ttyS%d" % (minor - 64)
+    return "?"
+
+
+def _format_start(start):
+    now = time.time()
+    if now - start > 3600 * 24 * 365:
+        fmt = "%Y"
+    elif now - start > 3600 * 24:
+        fmt = "%b%d"
+    else:
+        fmt = "%H:%M"
+    return time.strftime(fmt, time.localtime(start))
+
+
+def _format_cputime(seconds):
+    seconds = int(seconds)
+    return "%d:%02d" % (seconds // 60, seconds % 60)
+
+
+def _parse_cputime(value):
+    seconds = 0
+    for part in value.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+_ProcStat = namedtuple("_ProcStat", ["comm", "state", "ppid", "pgrp", "session",
+                                     "tty_nr", "tpgid", "cputime", "nice",
+                                     "num_threads", "starttime", "vsz", "rss"])
+
+
+def _proc_stat(pid):
+    """
+    Read the values of a process which may change at every refresh from
+    /proc/<pid>/stat, starttime is in clock ticks after boot
+    """
+    try:
+        data = _read(os.path.join(PROC_ROOT, str(pid), "stat"))
+    except (IOError, OSError):
+        raise UnfoundException("process %d not found" % pid)
+
+    try:
+        comm, fields = _parse_stat(data)
+        return _ProcStat(
+            comm, fields[0].decode(), int(fields[1]), int(fields[2]),
+            int(fields[3]), int(fields[4]), int(fields[5]),
+            (int(fields[11]) + int(fields[12])) / CLK_TCK,
+            int(fields[16]), int(fields[17]), int(fields[19]),
+            int(fields[20]) // 1024, int(fields[21]) * PAGE_SIZE // 1024)
+    except (IndexError, ValueError) as err:
+        raise CMDOutException("abnormal stat of process %d: %s" % (pid, err))
+
+
+def _read_status(pid):
+    try:
+        return _read(os.path.join(PROC_ROOT, str(pid), "status"))
+    except (IOError, OSError):
+        raise UnfoundException("process %d not found" % pid)
+
+
+def _proc_status(pid, status=None):
+    """
+    Read (user, locked) of a process from /proc/<pid>/status, or from its
+    content if given
+    """
+    if status is None:
+        status = _read_status(pid)
+    try:
+        uid, locked = 0, False
+        for line in status.splitlines():
+            if line.startswith(b"Uid:"):
+                uid = int(line.split()[2])  # effective uid, as ps does
+            elif line.startswith(b"VmLck:"):
+                locked = int(line.split()[1]) > 0
+    except (IndexError, ValueError) as err:
+        raise CMDOutException("abnormal status of process %d: %s" % (pid, err))
+    return _username(uid), locked
+
+
+def _proc_ctxt(pid, status=None):
+    """
+    Read (voluntary, nonvoluntary) context switches of a process from
+    /proc/<pid>/status, or from its content if given
+    """
+    if status is None:
+        status = _read_status(pid)
+    voluntary = nonvoluntary = None
+    try:
+        for line in status.splitlines():
+            if line.startswith(b"voluntary_ctxt_switches:"):
+                voluntary = int(line.split()[1])
+            elif line.startswith(b"nonvoluntary_ctxt_switches:"):
+                nonvoluntary = int(line.split()[1])
+    except (IndexError, ValueError) as err:
+        raise CMDOutException("abnormal status of process %d: %s" % (pid, err))
+    return voluntary, nonvoluntary
+
+
+def _proc_cmdline(pid, comm, state):
+    """
+    Read the command of a process from /proc/<pid>/cmdline, kernel threads
+    and zombies are shown with their name in brackets as ps does
+    """
+    try:
+        cmdline = _read(os.path.join(PROC_ROOT, str(pid), "cmdline"))
+    except (IOError, OSError):
+        raise UnfoundException("process %d not found" % pid)
+
+    cmd = b" ".join(arg for arg in cmdline.split(b"\0") if arg)
+    cmd = cmd.decode("utf-8", "replace")
+    if not cmd:
+        cmd = "[%s]" % comm
+        if state == "Z":
+            cmd += " <defunct>"
+    return cmd
+
+
+def _proc_io(pid):
+    """
+    Read (read_bytes, write_bytes, read_count, write_count) of a process
+    from /proc/<pid>/io, all None if it may not be read by this user
+    """
+    try:
+        data = _read(os.path.join(PROC_ROOT, str(pid), "io"))
+    except (IOError, OSError) as err:
+        if err.errno in (errno.EACCES, errno.EPERM):
+            return None, None, None, None
+        raise UnfoundException("process %d not found" % pid)
+
+    counters = {}
+    for line in data.splitlines():
+        key, _, value = line.partition(b":")
+        counters[key] = value
+    try:
+        return (int(counters[b"read_bytes"]), int(counters[b"write_bytes"]),
+                int(counters[b"syscr"]), int(counters[b"syscw"]))
+    except (KeyError, ValueError) as err:
+        raise CMDOutException("abnormal io of process %d: %s" % (pid, err))
+
+
+_smaps_keys = {b"Pss": 0, b"Private_Clean": 1, b"Private_Dirty": 1, b"Swap": 2,
+               b"SwapPss": 3}
+
+
+def _proc_smaps(pid):
+    """
+    Read (pss, uss, swap, swap_pss) of a process in kB from
+    /proc/<pid>/smaps_rollup, or by summing /proc/<pid>/smaps on kernels
+    before 4.14, all None if it may not be read by this user
+    """
+    for name in ("smaps_rollup", "smaps"):
+        try:
+            data = _read(os.path.join(PROC_ROOT, str(pid), name))
+            break
+        except (IOError, OSError) as err:
+            if err.errno in (errno.EACCES, errno.EPERM):
+                return None, None, None, None
+            if name == "smaps" or not os.path.isdir(os.path.join(PROC_ROOT, str(pid))):
+                raise UnfoundException("process %d not found" % pid)
+
+    values = [0, 0, 0, 0]
+    for line in data.splitlines():
+        key, _, value = line.partition(b":")
+        index = _smaps_keys.get(key)
+        if index is not None:
+            values[index] += int(value.split()[0])
+    return tuple(values)
+
+
+ThreadInfo = namedtuple("ThreadInfo", ["tid", "name", "state", "cputime",
+                                       "cpu_percent", "processor"])
+
+
+def _proc_threads(pid):
+    """
+    Yield (tid, name, state, cputime, starttime, processor) of every thread
+    of a process from /proc/<pid>/task/<tid>/stat, skipping the threads
+    which exit while they are read
+    """
+    task = os.path.join(PROC_ROOT, str(pid), "task")
+    try:
+        tids = os.listdir(task)
+    except (IOError, OSError):
+        raise UnfoundException("process %d not found" % pid)
+
+    for tid in tids:
+        try:
+            name, fields = _parse_stat(_read(os.path.join(task, tid, "stat")))
+        except (IOError, OSError):
+            continue
+        try:
+            yield (int(tid), name, fields[0].decode(),
+                   (int(fields[11]) + int(fields[12])) / CLK_TCK,
+                   int(fields[19]), int(fields[36]))
+        except (IndexError, ValueError) as err:
+            raise CMDOutException("abnormal stat of thread %s: %s" % (tid, err))
+
+
+def _proc_static(pid, st):
+    """
+    Read the values which do not change over the life of a process from
+    /proc/<pid>/status and /proc/<pid>/cmdline, return (user, locked, cmd)
+    """
+    user, locked = _proc_status(pid)
+    return user, locked, _proc_cmdline(pid, st.comm, st.state)
+
+
+def _stat_columns(pid, st):
+    """
+    Compute the 'ps -aux' columns which only depend on /proc/<pid>/stat:
+    (cpu, mem, vsz, rss, tty, stat). The 'L' flag of stat comes from
+    status, _with_locked() adds it.
+    """
+    start = _proc_const("btime") + st.starttime / CLK_TCK
+    elapsed = time.time() - start
+    memtotal = _proc_const("memtotal")
+
+    flags = st.state
+    if st.nice < 0:
+        flags += "<"
+    elif st.nice > 0:
+        flags += "N"
+    tail = ""
+    if st.session == pid:
+        tail += "s"
+    if st.num_threads > 1:
+        tail += "l"
+    if st.pgrp == st.tpgid:
+        tail += "+"
+
+    # Truncate to one decimal in the same way ps does
+    cputime = st.cputime
+    cpu = int(cputime * 1000 / elapsed) / 10.0 if elapsed > 0 else 0.0
+    mem = int(st.rss * 1000 / memtotal) / 10.0 if memtotal else 0.0
+
+    return cpu, mem, st.vsz, st.rss, _ttyname(st.tty_nr), flags + tail
+
+
+def _with_locked(stat):
+    """Add the 'L' flag to a stat column, after the state and priority"""
+    at = 2 if stat[1:2] in ("<", "N") else 1
+    return stat[:at] + "L" + stat[at:]
+
+
+def _ps_columns(pid, st, user, locked, cmd):
+    """
+    Compute the 'ps -aux' columns of a process, followed by the cpu time
+    in seconds
+    """
+    cpu, mem, vsz, rss, tty, flags = _stat_columns(pid, st)
+    if locked:
+        flags = _with_locked(flags)
+    start = _format_start(_proc_const("btime") + st.starttime / CLK_TCK)
+    return (user, pid, cpu, mem, vsz, rss, tty, flags, start,
+            _format_cputime(st.cputime), cmd, st.cputime)
+
+
+def _proc_row(pid):
+    """
+    Read the 'ps -aux' columns of a process from procfs, followed by the
+    cpu time in seconds
+    """
+    st = _proc_stat(pid)
+    return _ps_columns(pid, st, *_proc_static(pid, st))
+
+
+def _pidfd_open(pid):
+    """Return a pidfd of pid, None if pidfds are not supported"""
+    if not hasattr(os, "pidfd_open"):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def _send_signal(pid, pidfd, sig):
+    """Send sig to pid, return False if the process no longer exists"""
+    try:
+        if pidfd is not None and hasattr(signal, "pidfd_send_signal"):
+            signal.pidfd_send_signal(pidfd, sig)
+        else:
+            os.kill(pid, sig)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def _has_exited(pid, starttime=None):
+    """
+    Whether the process has exited: it is gone, a zombie, or its pid now
+    belongs to a process started at another time
+    """
+    if hasattr(os, "waitid"):
+        # A child of ours which exited, WNOWAIT leaves it to be reaped
+        try:
+            flags = os.WEXITED | os.WNOHANG | os.WNOWAIT
+            if os.waitid(os.P_PID, pid, flags) is not None:
+                return True
+        except ChildProcessError:
+            pass
+    if _procfs_available():
+        try:
+            st = _proc_stat(pid)
+        except UnfoundException:
+            return True
+        if starttime is not None and st.starttime != starttime:
+            return True
+        return st.state in ("Z", "X")
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def _wait_exit(pid, starttime=None, timeout=None, pidfd=None):
+    """
+    Wait for a process to exit, at most timeout seconds. A pidfd becomes
+    readable when the process exits, so it is polled without any busy
+    loop. Without pidfd the process is checked at increasing intervals.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    if pidfd is not None:
+        import select
+        if _has_exited(pid, starttime):
+            return True
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if deadline is None:
+            return bool(poller.poll())
+        return bool(poller.poll(max(int(timeout * 1000), 0)))
+
+    delay = 0.001
+    while not _has_exited(pid, starttime):
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return True
+
+
+# Field groups of a Process, each one is read from a single procfs file
+STAT, STATUS, CMDLINE, IO, SMAPS, CTXT = 1, 2, 4, 8, 16, 32
+_GROUPS = STAT | STATUS | CMDLINE | IO | SMAPS | CTXT
+_group_names = {"stat": STAT, "status": STATUS, "cmdline": CMDLINE, "io": IO,
+                "smaps": SMAPS, "ctxt": CTXT}
+
+# Flag kept with the groups in Process._loaded: the process has locked
+# memory, the 'L' of its stat column, read from status
+_LOCKED = 64
+
+# Rates computed from the counters of a group between two of its reads
+_rate_fields = {
+    "read_rate": (IO, 0), "write_rate": (IO, 1),
+    "read_count_rate": (IO, 2), "write_count_rate": (IO, 3),
+    "voluntary_ctxt_rate": (CTXT, 0), "nonvoluntary_ctxt_rate": (CTXT, 1),
+}
+
+# Reading smaps_rollup costs the kernel a walk of all the mappings of the
+# process, tens of times the cost of stat, so update() refreshes the smaps
+# group only when it is older than this many seconds
+SMAPS_MAX_AGE = 10.0
+
+
+class _ProcessExtra(object):
+    """
+    Fields of the groups few processes load (io, smaps, ctxt) and the
+    counters of Process.threads(), kept out of Process so that only the
+    processes using them pay for them. start is the start column of a
+    process read from ps, which has no start time in clock ticks.
+    """
+    __slots__ = ("read_bytes", "write_bytes", "read_count", "write_count",
+                 "io_at", "io_rates", "pss", "uss", "swap", "swap_pss",
+                 "smaps_at", "voluntary_ctxt", "nonvoluntary_ctxt", "ctxt_at",
+                 "ctxt_rates", "threads", "threads_at", "start")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+
+def _rate(name):
+    group, index = _rate_fields[name]
+    attr = "io_rates" if group == IO else "ctxt_rates"
+
+    def fget(self):
+        if self._extra is None:
+            return None
+        rates = getattr(self._extra, attr)
+        return None if rates is None else rates[index]
+
+    return property(fget, doc="Per second rate between the last two reads, "
+                              "None before the second one")
+
+
+def _field(name, groups):
+    attr = "_" + name
+
+    def fget(self):
+        if self._loaded & groups != groups:
+            self._load(groups & ~self._loaded)
+        return getattr(self, attr)
+
+    def fset(self, value):
+        setattr(self, attr, value)
+
+    return property(fget, fset)
+
+
+def _extra_field(name, groups):
+    def fget(self):
+        if self._loaded & groups != groups:
+            self._load(groups & ~self._loaded)
+        return None if self._extra is None else getattr(self._extra, name)
+
+    def fset(self, value):
+        setattr(self._get_extra(), name, value)
+
+    return property(fget, fset)
+
+
 class Process(object):
     """
-    Get a process information by 'ps -aux | grep pid'
-    """
-    def __init__(self, pid):
-        self.pid   = int(pid)
-        self.user  = None
-        self.cpu   = None
-        self.mem   = None
-        self.vsz   = None
-        self.rss   = None
-        self.tty   = None
-        self.stat  = None
-        self.start = None
-        self.time  = None
-        self.cmd   = None
-        self.update()
-
-    def update(self):
-        import os
-
-        def find_exe(exe):
-            for path in os.environ['PATH'].split(':'):
-                if path and os.path.exists(os.path.join(path, exe)):
-                    return os.path.join(path, exe)
-            raise UnfoundException("executable %s file not found" % exe)
-
-        ps_exe = find_exe("ps")
-        grep_exe = find_exe("grep")
+    Get a process information like 'ps -aux | grep pid'
+
+    The information is read from /proc/<pid> directly when procfs is
+    available, otherwise from the output of 'ps -aux | grep pid'.
+
+    The fields are loaded by groups, each read from one procfs file:
+    stat (cpu, mem, vsz, rss, tty, start, time, ppid), status (user), cmdline
+    (cmd), io (read_bytes, write_bytes, read_count, write_count), smaps
+    (pss, uss, swap, swap_pss) and ctxt (voluntary_ctxt, nonvoluntary_ctxt,
+    from status); the stat field needs both stat and status. A lazy
+    process reads nothing when it is created and loads each group on the
+    first access to one of its fields.
+
+    Once loaded, the io and ctxt groups are refreshed by every update(),
+    and the per second rates of their counters between the last two
+    reads are kept in read_rate, write_rate, read_count_rate,
+    write_count_rate, voluntary_ctxt_rate and nonvoluntary_ctxt_rate.
+
+    rss counts shared pages in every process which maps them, pss divides
+    them between those processes and uss is the memory only this process
+    uses, all in kB. The smaps group is costly to read, it is only loaded
+    on demand and refreshed by update() every SMAPS_MAX_AGE seconds.
+
+    To keep processes small, the start and time columns are formatted
+    from the start time and cpu time on access, and the fields of the
+    io, smaps and ctxt groups live in a side object allocated by the
+    first of them loaded.
+    """
+    __slots__ = ("pid", "_loaded", "_user", "_cpu", "_mem", "_vsz", "_rss",
+                 "_tty", "_stat", "_cmd", "_ppid", "_comm", "_starttime",
+                 "_cputime", "_sampled", "_cpu_recent", "_extra")
+
+    user  = _field("user", STATUS)
+    cpu   = _field("cpu", STAT)
+    mem   = _field("mem", STAT)
+    vsz   = _field("vsz", STAT)
+    rss   = _field("rss", STAT)
+    tty   = _field("tty", STAT)
+    cmd   = _field("cmd", CMDLINE)
+    ppid  = _field("ppid", STAT)
+
+    read_bytes  = _extra_field("read_bytes", IO)
+    write_bytes = _extra_field("write_bytes", IO)
+    read_count  = _extra_field("read_count", IO)
+    write_count = _extra_field("write_count", IO)
+
+    pss      = _extra_field("pss", SMAPS)
+    uss      = _extra_field("uss", SMAPS)
+    swap     = _extra_field("swap", SMAPS)
+    swap_pss = _extra_field("swap_pss", SMAPS)
+
+    voluntary_ctxt    = _extra_field("voluntary_ctxt", CTXT)
+    nonvoluntary_ctxt = _extra_field("nonvoluntary_ctxt", CTXT)
+
+    read_rate              = _rate("read_rate")
+    write_rate             = _rate("write_rate")
+    read_count_rate        = _rate("read_count_rate")
+    write_count_rate       = _rate("write_count_rate")
+    voluntary_ctxt_rate    = _rate("voluntary_ctxt_rate")
+    nonvoluntary_ctxt_rate = _rate("nonvoluntary_ctxt_rate")
+
+    def __init__(self, pid, lazy=False):
+        self.pid     = int(pid)
+        self._loaded = 0
+        self._user   = None
+        self._cpu    = None
+        self._mem    = None
+        self._vsz    = None
+        self._rss    = None
+        self._tty    = None
+        self._stat   = None
+        self._cmd    = None
+
+        self._ppid       = None
+        self._comm       = None
+        self._starttime  = None
+        self._cputime    = None
+        self._sampled    = None
+        self._cpu_recent = None
+        self._extra      = None
+        if not lazy:
+            # The first update, not timed as one by instrument()
+            self._load(STAT | STATUS | CMDLINE)
+
+    def _get_extra(self):
+        if self._extra is None:
+            self._extra = _ProcessExtra()
+        return self._extra
+
+    # Pickle the slots as a plain tuple, which is much smaller and faster
+    # than the default state of a slotted object (Scanner sends processes
+    # back from worker processes)
+    def __getstate__(self):
+        return _process_state(self)
+
+    def __setstate__(self, state):
+        for name, value in zip(Process.__slots__, state):
+            setattr(self, name, value)
+
+    @property
+    def stat(self):
+        if self._loaded & (STAT | STATUS) != STAT | STATUS:
+            self._load((STAT | STATUS) & ~self._loaded)
+        if self._loaded & _LOCKED:
+            return _with_locked(self._stat)
+        return self._stat
+
+    @stat.setter
+    def stat(self, value):
+        self._stat = value
+
+    @property
+    def start(self):
+        if not self._loaded & STAT:
+            self._load(STAT)
+        if self._starttime is None:
+            return None if self._extra is None else self._extra.start
+        return _format_start(_proc_const("btime") + self._starttime / CLK_TCK)
+
+    @property
+    def time(self):
+        if not self._loaded & STAT:
+            self._load(STAT)
+        return None if self._cputime is None else _format_cputime(self._cputime)
+
+    def update(self, full=False):
+        """
+        Refresh the information of the process. The user and cmd fields,
+        which do not change over the life of a process, are read by the
+        first update only, unless full is true; the io and ctxt groups are
+        refreshed if they have been loaded, the smaps group if it has been
+        loaded and is older than SMAPS_MAX_AGE. If the pid has been reused
+        by a new process, UnfoundException is raised as for an exited one.
+        """
+        groups = STAT | (self._loaded & (IO | CTXT))
+        if full:
+            groups |= STATUS | CMDLINE
+        else:
+            groups |= (STATUS | CMDLINE) & ~self._loaded
+        if self._loaded & SMAPS and (full or self.smaps_age() >= SMAPS_MAX_AGE):
+            groups |= SMAPS
+        self._load(groups)
+
+    def smaps_age(self):
+        """Seconds since the smaps group was read, None if it never was"""
+        if self._extra is None or self._extra.smaps_at is None:
+            return None
+        return time.monotonic() - self._extra.smaps_at
+
+    def refresh(self, *groups):
+        """
+        Re-read the given field groups ("stat", "status", "cmdline", "io",
+        "smaps"), by default all the groups loaded so far
+        """
+        mask = 0
+        for name in groups:
+            mask |= _group_names[name]
+        self._load(mask or self._loaded & _GROUPS or STAT)
+
+    def _load(self, groups):
+        if _procfs_available():
+            self._read_groups(groups)
+        else:
+            self._update_by_ps()
+            self._loaded |= groups
+
+    def _read_groups(self, groups):
+        if groups & STAT or (groups & CMDLINE and not self._loaded & STAT):
+            self._set_stat(_proc_stat(self.pid))
+        if groups & (STATUS | CTXT):
+            status = _read_status(self.pid)
+            if groups & STATUS:
+                self._user, locked = _proc_status(self.pid, status)
+                self._loaded = (self._loaded | STATUS | _LOCKED) if locked else \
+                               (self._loaded | STATUS) & ~_LOCKED
+            if groups & CTXT:
+                counters = _proc_ctxt(self.pid, status)
+                extra = self._get_extra()
+                extra.ctxt_at, extra.ctxt_rates = self._rates(
+                    (extra.voluntary_ctxt, extra.nonvoluntary_ctxt), counters, extra.ctxt_at)
+                extra.voluntary_ctxt, extra.nonvoluntary_ctxt = counters
+                self._loaded |= CTXT
+        if groups & CMDLINE:
+            self._cmd = _proc_cmdline(self.pid, self._comm, self._stat[0])
+            self._loaded |= CMDLINE
+        if groups & IO:
+            counters = _proc_io(self.pid)
+            extra = self._get_extra()
+            extra.io_at, extra.io_rates = self._rates(
+                (extra.read_bytes, extra.write_bytes, extra.read_count, extra.write_count),
+                counters, extra.io_at)
+            extra.read_bytes, extra.write_bytes, extra.read_count, \
+            extra.write_count = counters
+            self._loaded |= IO
+        if groups & SMAPS:
+            extra = self._get_extra()
+            extra.pss, extra.uss, extra.swap, extra.swap_pss = _proc_smaps(self.pid)
+            extra.smaps_at = time.monotonic()
+            self._loaded |= SMAPS
+
+    @staticmethod
+    def _rates(previous, current, sampled):
+        """Return (now, per second rates from previous to current counters)"""
+        now = time.monotonic()
+        if sampled is None or now <= sampled or None in previous or None in current:
+            return now, None
+        elapsed = now - sampled
+        return now, tuple(max(c - p, 0) / elapsed for p, c in zip(previous, current))
+
+    def _set_stat(self, st):
+        if self._starttime is not None and st.starttime != self._starttime:
+            raise UnfoundException("process %d not found" % self.pid)
+        self._starttime = st.starttime
+        self._ppid = st.ppid
+        self._comm = st.comm
+        self._cpu, self._mem, self._vsz, self._rss, self._tty, self._stat = \
+            _stat_columns(self.pid, st)
+        self._sample_cputime(st.cputime)
+        self._loaded |= STAT
+
+    @property
+    def ident(self):
+        """(pid, start time), which identifies a process even across pid reuse"""
+        if self._starttime is not None:
+            return self.pid, self._starttime
+        return self.pid, self.start
+
+    def _update_by_ps(self):
+        ps_exe = _find_exe("ps")
+        grep_exe = _find_exe("grep")
 
         ps_args = "-aux"  # List all the process
         grep_args = "-E '^.+ %d .+ [0-9]{1,2}\.[0-9]{1} .+$'"
@@ -65,20 +868,121 @@ class Process(object):
         if len(pinfo) != 11:
             raise CMDOutException("abnormal output", "".join(outs))
 
+        self._set_ps_row(pinfo)
+
+    def _set_ps_row(self, pinfo):
         convert_funcs = [str, int, float, float, int, int] + [str] * 5
         pinfo = [f(v) for v, f in zip(pinfo, convert_funcs)]
+        self._set_row(pinfo + [_parse_cputime(pinfo[9])])
+
+    def _set_row(self, pinfo):
+        self._user, self.pid, self._cpu, self._mem, self._vsz, self._rss, \
+        self._tty, self._stat = pinfo[:8]
+        self._cmd = pinfo[10]
+        self._get_extra().start = pinfo[8]
+        self._loaded |= STAT | STATUS | CMDLINE
+        self._sample_cputime(pinfo[11] if len(pinfo) > 11 else _parse_cputime(pinfo[9]))
+
+    def _sample_cputime(self, cputime):
+        now = time.monotonic()
+        if self._cputime is not None and now > self._sampled:
+            delta = max(cputime - self._cputime, 0)
+            self._cpu_recent = delta * 100 / (now - self._sampled)
+        self._cputime = cputime
+        self._sampled = now
+
+    def cpu_percent(self, per_core=False):
+        """
+        CPU usage between the last two updates, unlike the cpu attribute,
+        which 'ps' averages over the whole lifetime of the process. Before
+        the second update the lifetime average is returned. With per_core
+        the value is divided by the number of CPUs, so it is at most 100.
+        """
+        percent = self.cpu if self._cpu_recent is None else self._cpu_recent
+        if per_core:
+            percent /= os.cpu_count() or 1
+        return round(percent, 1)
+
+    def threads(self):
+        """
+        Return a ThreadInfo for every thread of the process, read in one
+        pass over /proc/<pid>/task. cpu_percent is the usage of the thread
+        since the previous call, or over its lifetime for the threads this
+        process has not seen yet; the previous counters are kept by the
+        process object, so call it on the same object every tick.
+        """
+        if not _procfs_available():
+            raise UnfoundException("threads need procfs")
+        now = time.monotonic()
+        wall = time.time()
+        btime = _proc_const("btime")
+        extra = self._get_extra()
+        # tid -> (starttime, cputime) of the previous call
+        previous = extra.threads or {}
+        elapsed = now - extra.threads_at if extra.threads_at is not None else 0
+        counters = {}
+        threads = []
+        for tid, name, state, cputime, starttime, processor in _proc_threads(self.pid):
+            counters[tid] = starttime, cputime
+            before = previous.get(tid)
+            if before is not None and before[0] == starttime and elapsed > 0:
+                percent = max(cputime - before[1], 0) * 100 / elapsed
+            else:
+                age = wall - (btime + starttime / CLK_TCK)
+                percent = cputime * 100 / age if age > 0 else 0.0
+            threads.append(ThreadInfo(tid, name, state, cputime,
+                                      round(percent, 1), processor))
+        extra.threads = counters
+        extra.threads_at = now
+        return threads
 
-        self.user, self.pid, self.cpu, self.mem, self.vsz, self.rss, \
-        self.tty, self.stat, self.start, self.time, self.cmd = pinfo
+    def top_threads(self, n=5):
+        """The n threads using the most CPU since the previous call"""
+        return heapq.nlargest(n, self.threads(), key=operator.attrgetter("cpu_percent"))
 
-    def kill(self):
-        from os import kill
-        from signal import SIGTERM
+    async def aupdate(self):
+        """Asynchronous version of update(), run in the pps executor"""
+        await _run_blocking(self.update)
+
+    def kill(self, sig=signal.SIGTERM, timeout=5, escalate=True):
+        """
+        Send sig to the process once and wait for it to exit. If it is
+        still alive after timeout seconds and escalate is true, SIGKILL is
+        sent and waited for the same time. Return the seconds the process
+        took to exit, or None if it did not, which includes a process of
+        another user we have no permission to signal.
+        """
+        started = time.monotonic()
+        pidfd = _pidfd_open(self.pid)
         try:
-            while 1:
-                kill(self.pid, SIGTERM)
-        except OSError:
-            pass
+            if _has_exited(self.pid, self._starttime):
+                return 0.0
+            if not _send_signal(self.pid, pidfd, sig):
+                return time.monotonic() - started
+            if _wait_exit(self.pid, self._starttime, timeout, pidfd):
+                return time.monotonic() - started
+            if escalate and sig != signal.SIGKILL:
+                _send_signal(self.pid, pidfd, signal.SIGKILL)
+                if _wait_exit(self.pid, self._starttime, timeout, pidfd):
+                    return time.monotonic() - started
+            return None
+        except PermissionError:
+            return None
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+
+    def wait_exit(self, timeout=None):
+        """
+        Wait until the process exits, forever if timeout is None, and
+        return whether it did. A zombie counts as exited.
+        """
+        pidfd = _pidfd_open(self.pid)
+        try:
+            return _wait_exit(self.pid, self._starttime, timeout, pidfd)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
 
     def to_dict(self):
         return {
@@ -103,75 +1007,2238 @@ class Process(object):
         return dumps(self.to_dict())
 
 
-def processes():
-    import os
+_process_state = operator.attrgetter(*Process.__slots__)
 
-    def find_exe(exe):
-        for path in os.environ['PATH'].split(':'):
-            if path and os.path.exists(os.path.join(path, exe)):
-                return os.path.join(path, exe)
-        raise UnfoundException("executable %s file not found" % exe)
 
-    ps_exe = find_exe("ps")
-    grep_exe = find_exe("grep")
-    awk_exe = find_exe("awk")
+class Snapshot(object):
+    """
+    Processes collected by a single scan of the process table
 
-    ps_args = "-aux"
-    grep_args = "-v PID"
-    awk_args = "'{print $2}'"
+    timestamp is the time the scan started, duration how long it took,
+    vanished the number of pids that exited between listing and reading
+    and unparsed the number of pids skipped because their procfs files
+    (or ps output lines) could not be parsed.
+    The fields diff() compares are recorded when the snapshot is created,
+    since the processes of a ProcessCache are shared by its snapshots and
+    updated in place.
+    """
+    def __init__(self, procs, timestamp, duration=0.0, vanished=0, unparsed=0):
+        self.processes = procs
+        self.timestamp = timestamp
+        self.duration  = duration
+        self.vanished  = vanished
+        self.unparsed  = unparsed
+        self._by_pid   = None
+        self._recorded = [_record(p) for p in procs]
 
-    cmd = " ".join([ps_exe, ps_args, "|", grep_exe, grep_args, "|", awk_exe, awk_args])
-    with os.popen(cmd) as f:
-        for pid in f:
+    def get(self, pid, default=None):
+        if self._by_pid is None:
+            self._by_pid = dict((p.pid, p) for p in self.processes)
+        return self._by_pid.get(pid, default)
+
+    def pids(self):
+        return [p.pid for p in self.processes]
+
+    def __iter__(self):
+        return iter(self.processes)
+
+    def __len__(self):
+        return len(self.processes)
+
+    def __contains__(self, pid):
+        return self.get(pid) is not None
+
+    def diff(self, previous, thresholds=None):
+        """
+        Return the SnapshotDiff from a previous snapshot, processes are
+        matched by ident so a reused pid is an exit and a spawn
+
+        A process is changed when a field of thresholds (CHANGE_THRESHOLDS
+        by default) moved by at least its threshold, or differs at all when
+        the threshold is None. changed holds (process, previous) pairs,
+        previous maps the fields to their values in the previous snapshot.
+        cpu is the usage between the two snapshots. The fields are those of
+        DIFF_FIELDS, as recorded when each snapshot was created.
+        """
+        thresholds = CHANGE_THRESHOLDS if thresholds is None else thresholds
+        for name in thresholds:
+            if name not in DIFF_FIELDS:
+                raise ValueError("field %s is not recorded by snapshots" % name)
+        before = dict((rec[0], (p, rec)) for p, rec in
+                      zip(previous.processes, previous._recorded))
+        idents = set()
+        spawned, changed = [], []
+        for p, rec in zip(self.processes, self._recorded):
+            idents.add(rec[0])
+            old = before.get(rec[0])
+            if old is None:
+                spawned.append(p)
+                continue
+            values = _recorded_values(old[1], None, thresholds)
+            if _has_changed(values, _recorded_values(rec, old[1], thresholds), thresholds):
+                changed.append((p, dict(zip(thresholds, values))))
+        exited = [p for ident, (p, _) in before.items() if ident not in idents]
+        return SnapshotDiff(spawned, exited, changed)
+
+    def __repr__(self):
+        return "pps.Snapshot(processes={}, timestamp={}, vanished={})".format(
+            len(self.processes), self.timestamp, self.vanished)
+
+
+# Smallest moves of the fields which make a process changed in a diff:
+# percent of CPU, percent of memory, rss in kB, and any change of stat
+CHANGE_THRESHOLDS = OrderedDict([("cpu", 5.0), ("mem", 1.0), ("rss", 10240),
+                                 ("stat", None)])
+
+SnapshotDiff = namedtuple("SnapshotDiff", ["spawned", "exited", "changed"])
+SnapshotDiff.__bool__ = lambda self: bool(self.spawned or self.exited or self.changed)
+
+
+# Fields of the processes recorded by a Snapshot for diff()
+DIFF_FIELDS = ("cpu", "mem", "rss", "vsz", "stat", "ppid")
+_diff_index = dict((name, i + 3) for i, name in enumerate(DIFF_FIELDS))
+_record_fields = operator.attrgetter("ident", "_cputime", "_sampled", *DIFF_FIELDS[1:])
+
+
+def _record(proc):
+    """(ident, cputime, sampled, cpu, mem, rss, ...) of proc at this time"""
+    fields = _record_fields(proc)
+    return fields[:3] + (proc.cpu_percent(),) + fields[3:]
+
+
+def _recorded_values(rec, previous, thresholds):
+    """
+    Values of the fields of thresholds in a record, cpu being the usage
+    since the previous record of the process when there is one
+    """
+    values = []
+    for name in thresholds:
+        if (name == "cpu" and previous is not None and rec[1] is not None and
+                previous[1] is not None and rec[2] > previous[2]):
+            values.append(max(rec[1] - previous[1], 0) * 100 / (rec[2] - previous[2]))
+        else:
+            values.append(rec[_diff_index[name]])
+    return tuple(values)
+
+
+def _has_changed(old, new, thresholds):
+    for a, b, limit in zip(old, new, thresholds.values()):
+        if limit is None:
+            if a != b:
+                return True
+        elif abs(b - a) >= limit:
+            return True
+    return False
+
+
+def _find_exe(exe):
+    for path in os.environ['PATH'].split(':'):
+        if path and os.path.exists(os.path.join(path, exe)):
+            return os.path.join(path, exe)
+    raise UnfoundException("executable %s file not found" % exe)
+
+
+def _pids():
+    return [int(name) for name in os.listdir(PROC_ROOT) if name.isdigit()]
+
+
+def _scan_rows():
+    """
+    Yield the 'ps -aux' columns of every process in one pass, None is
+    yielded for each pid which exited before it could be read and the
+    CMDOutException of each pid or ps line which could not be parsed
+    """
+    if _procfs_available():
+        for pid in _pids():
             try:
-                yield Process(int(pid))
-            except Exception:
+                yield _proc_row(pid)
+            except UnfoundException:
+                yield None
+            except CMDOutException as err:
+                yield err
+    else:
+        # One 'ps -aux' run already has every column of every process
+        convert_funcs = [str, int, float, float, int, int] + [str] * 5
+        with os.popen(_find_exe("ps") + " -aux") as f:
+            f.readline()  # header
+            for line in f:
+                pinfo = line.strip().split(None, 10)
+                try:
+                    if len(pinfo) != 11:
+                        raise ValueError("expected 11 columns")
+                    yield tuple(f(v) for v, f in zip(pinfo, convert_funcs))
+                except ValueError:
+                    yield CMDOutException("abnormal output", line)
+
+
+def _scan_chunk(pids, root=None):
+    """
+    Read the processes of pids, return them with the number of pids which
+    vanished and of pids whose files could not be parsed. root is set as
+    PROC_ROOT first in worker processes.
+    """
+    if root is not None:
+        global PROC_ROOT
+        PROC_ROOT = root
+    procs = []
+    vanished = unparsed = 0
+    for pid in pids:
+        p = Process(pid, lazy=True)
+        try:
+            p._read_groups(STAT | STATUS | CMDLINE)
+        except UnfoundException:
+            vanished += 1
+            continue
+        except CMDOutException:
+            unparsed += 1
+            continue
+        procs.append(p)
+    return procs, vanished, unparsed
+
+
+def snapshot():
+    """
+    Scan the process table once and return a Snapshot of all processes
+    """
+    timestamp = time.time()
+    procs = []
+    vanished = unparsed = 0
+    if _procfs_available():
+        procs, vanished, unparsed = _scan_chunk(_pids())
+    else:
+        for row in _scan_rows():
+            if isinstance(row, CMDOutException):
+                unparsed += 1
                 continue
-    pass
+            p = Process(row[1], lazy=True)
+            p._set_row(row)
+            procs.append(p)
+    return Snapshot(procs, timestamp, time.time() - timestamp, vanished, unparsed)
 
-def mem_percent():
-    with open("/proc/meminfo") as f:
-        meminfo = {}
-        for line in f:
-            k, v = [x.strip() for x in line.split(":")]
-            if k in ("MemTotal", "MemFree", "Buffers", "Cached"):
-                v, u = v.split()
-                if u == "kB":
-                    v = float(v)
-                elif u == "mB":
-                    v = float(v) * 1024
-                elif u == "gB":
-                    v = float(v) * 1024 * 1024
-                else:
-                    raise UnfoundException("Undefined unit: %s"%u)
-
-                meminfo[k] = v
-
-    memfree = meminfo["MemFree"] + meminfo["Buffers"] + meminfo["Cached"]
-    percent = (1 - memfree/meminfo["MemTotal"]) * 100
-    return round(percent, 2)
 
-def cpu_percent():
-    def cputimes():
-        with open("/proc/stat") as f:
-            cpuinfo = [float(x) for x in f.readline().split()[1:]]
-            total_cputime = sum(cpuinfo)
-            idle_cputime = cpuinfo[3]
+class Scanner(object):
+    """
+    Scan the process table with a pool of workers
 
-        return total_cputime, idle_cputime
+    The pid list is split into chunks read by the workers, threads by
+    default since most of a scan is spent in syscalls, or processes when
+    use_processes is true, and the results are merged into one Snapshot
+    in pid list order. Below threshold processes, or with a single worker,
+    the scan runs serially in the calling thread, where a pool costs more
+    than it saves. The pool is created on the first parallel scan and
+    kept until close().
+    """
+    def __init__(self, workers=None, threshold=2000, use_processes=False, chunks_per_worker=4):
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 2)
+        self.threshold = threshold
+        self.use_processes = use_processes
+        self.chunks_per_worker = chunks_per_worker
+        self._pool = None
 
-    import time
-    total_cputime_1, idle_cputime_1 = cputimes()
-    time.sleep(0.1)
-    total_cputime_2, idle_cputime_2 = cputimes()
-    total_cputime = total_cputime_2 - total_cputime_1
-    idle_cputime = idle_cputime_2 - idle_cputime_1
-    percent = ((total_cputime - idle_cputime) / total_cputime) * 100
-    return round(percent, 2)
+    def _get_pool(self):
+        if self._pool is None:
+            if self.use_processes:
+                from concurrent.futures import ProcessPoolExecutor
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix="pps-scan")
+        return self._pool
+
+    def snapshot(self):
+        """Scan the process table once and return a Snapshot"""
+        if not _procfs_available():
+            return snapshot()
+        timestamp = time.time()
+        pids = _pids()
+        if self.workers <= 1 or len(pids) < self.threshold:
+            procs, vanished, unparsed = _scan_chunk(pids)
+            return Snapshot(procs, timestamp, time.time() - timestamp, vanished, unparsed)
 
+        size = -(-len(pids) // (self.workers * self.chunks_per_worker))
+        root = PROC_ROOT if self.use_processes else None
+        pool = self._get_pool()
+        futures = [pool.submit(_scan_chunk, pids[i:i + size], root)
+                   for i in range(0, len(pids), size)]
+        procs, vanished, unparsed = [], 0, 0
+        for future in futures:
+            chunk, chunk_vanished, chunk_unparsed = future.result()
+            procs.extend(chunk)
+            vanished += chunk_vanished
+            unparsed += chunk_unparsed
+        return Snapshot(procs, timestamp, time.time() - timestamp, vanished, unparsed)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ProcessTable(object):
+    """
+    Columnar snapshot of the process table
+
+    Numeric columns (pid, cpu, mem, vsz, rss) are kept in typed contiguous
+    arrays, numpy arrays when numpy is installed and array.array otherwise,
+    users are stored as integer codes into ProcessTable.users and the other
+    columns as lists of strings. Masks are numpy bool arrays or lists of
+    bools, several of them can be combined by select().
+    """
+    COLUMNS = ("user", "pid", "cpu", "mem", "vsz", "rss",
+               "tty", "stat", "start", "time", "cmd")
+    TYPECODES = {"pid": "q", "cpu": "d", "mem": "d", "vsz": "q", "rss": "q"}
+
+    _ops = {
+        "<": operator.lt, "<=": operator.le,
+        ">": operator.gt, ">=": operator.ge,
+        "==": operator.eq, "!=": operator.ne,
+    }
+
+    def __init__(self, columns, users, user_codes, timestamp=None, vanished=0, unparsed=0):
+        _import_numpy()
+        self.columns    = columns
+        self.users      = users
+        self.user_codes = user_codes
+        self.timestamp  = timestamp
+        self.vanished   = vanished
+        self.unparsed   = unparsed
+
+    @classmethod
+    def scan(cls):
+        """Build a table by a single scan of the process table"""
+        timestamp = time.time()
+        rows, vanished, unparsed = [], 0, 0
+        for row in _scan_rows():
+            if row is None:
+                vanished += 1
+            elif isinstance(row, CMDOutException):
+                unparsed += 1
+            else:
+                rows.append(row)
+        return cls.from_rows(rows, timestamp, vanished, unparsed)
+
+    @classmethod
+    def from_snapshot(cls, snap):
+        rows = ((p.user, p.pid, p.cpu, p.mem, p.vsz, p.rss, p.tty, p.stat,
+                 p.start, p.time, p.cmd) for p in snap)
+        return cls.from_rows(rows, snap.timestamp, snap.vanished, snap.unparsed)
+
+    @classmethod
+    def from_rows(cls, rows, timestamp=None, vanished=0, unparsed=0):
+        _import_numpy()
+        numeric = dict((name, array(code)) for name, code in cls.TYPECODES.items())
+        strings = dict((name, []) for name in ("tty", "stat", "start", "time", "cmd"))
+        users, user_index, user_codes = [], {}, array("i")
+        for row in rows:
+            code = user_index.get(row[0])
+            if code is None:
+                code = user_index[row[0]] = len(users)
+                users.append(row[0])
+            user_codes.append(code)
+            numeric["pid"].append(row[1])
+            numeric["cpu"].append(row[2])
+            numeric["mem"].append(row[3])
+            numeric["vsz"].append(row[4])
+            numeric["rss"].append(row[5])
+            strings["tty"].append(row[6])
+            strings["stat"].append(row[7])
+            strings["start"].append(row[8])
+            strings["time"].append(row[9])
+            strings["cmd"].append(row[10])
+
+        if numpy is not None:
+            for name, column in numeric.items():
+                numeric[name] = numpy.array(column, dtype=column.typecode)
+            user_codes = numpy.array(user_codes, dtype=user_codes.typecode)
+        numeric.update(strings)
+        return cls(numeric, users, user_codes, timestamp, vanished, unparsed)
+
+    def __len__(self):
+        return len(self.columns["pid"])
+
+    def __getitem__(self, name):
+        if name == "user":
+            users = self.users
+            return [users[code] for code in self.user_codes]
+        return self.columns[name]
+
+    def mask(self, name, op, value):
+        """
+        Mask of the rows where 'column op value' holds, for example
+        table.mask("mem", ">", 5)
+        """
+        func = self._ops[op]
+        column = self[name]
+        if numpy is not None and name in self.TYPECODES:
+            return func(column, value)
+        return [func(v, value) for v in column]
+
+    def user_mask(self, user):
+        try:
+            code = self.users.index(user)
+        except ValueError:
+            code = -1
+        if numpy is not None:
+            return self.user_codes == code
+        return [c == code for c in self.user_codes]
+
+    def _indices(self, masks):
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            for m in masks:
+                mask &= numpy.asarray(m, dtype=bool)
+            return numpy.flatnonzero(mask)
+        indices = range(len(self))
+        for m in masks:
+            indices = [i for i in indices if m[i]]
+        return list(indices)
+
+    def take(self, indices):
+        """Return a new table of the rows at the given indices"""
+        columns = {}
+        for name, column in self.columns.items():
+            if numpy is not None and name in self.TYPECODES:
+                columns[name] = column[indices]
+            elif name in self.TYPECODES:
+                columns[name] = array(column.typecode, [column[i] for i in indices])
+            else:
+                columns[name] = [column[i] for i in indices]
+        if numpy is not None:
+            user_codes = self.user_codes[indices]
+        else:
+            user_codes = array("i", [self.user_codes[i] for i in indices])
+        return self.__class__(columns, self.users, user_codes,
+                              self.timestamp, self.vanished, self.unparsed)
+
+    def select(self, *masks):
+        """Return a new table of the rows matched by all masks"""
+        return self.take(self._indices(masks))
+
+    def argsort(self, by, reverse=False):
+        column = self[by]
+        if numpy is not None and by in self.TYPECODES:
+            indices = numpy.argsort(column, kind="stable")
+            return indices[::-1] if reverse else indices
+        return sorted(range(len(column)), key=column.__getitem__, reverse=reverse)
+
+    def sort(self, by, reverse=False):
+        return self.take(self.argsort(by, reverse))
+
+    def argtop(self, n, by="rss"):
+        """Indices of the n rows with the largest values of a column"""
+        column = self.columns[by]
+        n = min(n, len(column))
+        if n <= 0:
+            return numpy.array([], dtype=int) if numpy is not None else []
+        if numpy is not None:
+            part = numpy.argpartition(column, -n)[-n:]
+            return part[numpy.argsort(column[part])[::-1]]
+        return heapq.nlargest(n, range(len(column)), key=column.__getitem__)
+
+    def top(self, n, by="rss"):
+        """Return a new table of the n rows with the largest values of a column"""
+        return self.take(self.argtop(n, by))
+
+    def sum_by_user(self, name):
+        """Sum a numeric column per user, return a dict of user -> sum"""
+        column = self.columns[name]
+        if numpy is not None:
+            sums = numpy.bincount(self.user_codes, weights=column,
+                                  minlength=len(self.users))
+            if self.TYPECODES[name] == "q":
+                sums = sums.astype("q")
+            sums = sums.tolist()
+        else:
+            sums = [0] * len(self.users)
+            for code, value in zip(self.user_codes, column):
+                sums[code] += value
+        return dict(zip(self.users, sums))
+
+    def row(self, index):
+        return dict((name, self._value(name, index)) for name in self.COLUMNS)
+
+    def _value(self, name, index):
+        if name == "user":
+            return self.users[self.user_codes[index]]
+        value = self.columns[name][index]
+        return value.item() if hasattr(value, "item") else value
+
+    def to_dicts(self):
+        return [self.row(i) for i in range(len(self))]
+
+    def __repr__(self):
+        return "pps.ProcessTable(rows={}, timestamp={})".format(
+            len(self), self.timestamp)
+
+
+class _ProcessFilter(object):
+    """
+    Match processes against the filters of processes(), checking the
+    cheap data first: the owner of /proc/<pid>, then the name and rss
+    from /proc/<pid>/stat. Only the survivors have their status and
+    cmdline read, before the cmd_re and predicate filters. The directory
+    of a non-dumpable process is owned by root whatever its user, so a
+    root-owned one is checked later against the user of its status.
+    """
+    def __init__(self, user=None, name=None, cmd_re=None, min_rss=None,
+                 predicate=None):
+        self.user = user
+        self.uid = None
+        if user is not None:
+            import pwd
+            try:
+                self.uid = pwd.getpwnam(user).pw_uid
+            except KeyError:
+                self.uid = -1
+        self.name = name
+        if cmd_re is not None and not hasattr(cmd_re, "search"):
+            import re
+            cmd_re = re.compile(cmd_re)
+        self.cmd_re = cmd_re
+        self.min_rss = min_rss
+        self.predicate = predicate
+
+    def read(self, pid):
+        """
+        Return the Process of pid if it matches, None otherwise, raise
+        UnfoundException if the process does not exist and CMDOutException
+        if its files cannot be parsed. Errors of predicate propagate.
+        """
+        if self.uid is not None:
+            try:
+                owner = os.stat(os.path.join(PROC_ROOT, str(pid))).st_uid
+            except (IOError, OSError):
+                raise UnfoundException("process %d not found" % pid)
+            if owner != self.uid and owner != 0:
+                return None
+
+        st = _proc_stat(pid)
+        if self.name is not None and st.comm != self.name:
+            return None
+        if self.min_rss is not None and st.rss < self.min_rss:
+            return None
+
+        # The survivors are read in full like the processes of a snapshot,
+        # so nothing is left to read, or to fail, once they are yielded
+        p = Process(pid, lazy=True)
+        p._set_stat(st)
+        p._read_groups(STATUS | CMDLINE)
+        return p if self.match(p, cheap=False) else None
+
+    def match(self, p, cheap=True):
+        if cheap:
+            # Without procfs the name is guessed from the command
+            argv0 = p.cmd.split(None, 1)[0] if p.cmd else ""
+            if self.name is not None and os.path.basename(argv0).strip("[]") != self.name:
+                return False
+            if self.min_rss is not None and p.rss < self.min_rss:
+                return False
+        if self.user is not None and p.user != self.user:
+            return False
+        if self.cmd_re is not None and not self.cmd_re.search(p.cmd):
+            return False
+        if self.predicate is not None and not self.predicate(p):
+            return False
+        return True
+
+
+def processes(user=None, name=None, cmd_re=None, min_rss=None, predicate=None):
+    """
+    Iterate over all processes, or only those matching the filters: owned
+    by user, with the process name (as in /proc/<pid>/stat) name, with a
+    command matching the regular expression cmd_re, with at least min_rss
+    KB resident and for which predicate(process) is true. Cheap filters
+    are checked before the expensive fields of a process are read.
+    Processes which exit or whose files cannot be parsed are skipped,
+    exceptions raised by predicate propagate.
+    """
+    filters = _ProcessFilter(user, name, cmd_re, min_rss, predicate)
+    if _procfs_available():
+        for pid in _pids():
+            try:
+                p = filters.read(pid)
+            except (UnfoundException, CMDOutException):
+                continue
+            if p is not None:
+                yield p
+        return
+
+    ps_exe = _find_exe("ps")
+    grep_exe = _find_exe("grep")
+    awk_exe = _find_exe("awk")
+
+    ps_args = "-aux"
+    grep_args = "-v PID"
+    awk_args = "'{print $2}'"
+
+    cmd = " ".join([ps_exe, ps_args, "|", grep_exe, grep_args, "|", awk_exe, awk_args])
+    with os.popen(cmd) as f:
+        for pid in f:
+            try:
+                p = Process(int(pid))
+            except Exception:
+                continue
+            if filters.match(p):
+                yield p
+    pass
+
+
+class ProcessCache(object):
+    """
+    Registry of Process objects keyed by pid and checked by start time
+
+    The static fields of a process are parsed and its user name resolved
+    once, later lookups only refresh the dynamic fields. A pid reused by a
+    new process is detected by its start time and gets a new Process.
+    Entries are evicted when their process exits, when they have not been
+    used for ttl seconds, or in least recently used order above maxsize.
+    """
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.hits    = 0
+        self.misses  = 0
+        self.reused  = 0
+        self.evicted = 0
+        self._procs  = OrderedDict()  # pid -> [process, last used], LRU first
+
+    def get(self, pid):
+        """
+        Return the refreshed Process of pid, raise UnfoundException if it
+        does not exist
+        """
+        pid = int(pid)
+        now = time.monotonic()
+        entry = self._procs.get(pid)
+        if entry is not None:
+            try:
+                entry[0].update()
+            except (UnfoundException, CMDOutException):
+                del self._procs[pid]
+            else:
+                self.hits += 1
+                entry[1] = now
+                self._procs.move_to_end(pid)
+                self.evict()
+                return entry[0]
+
+        proc = Process(pid)
+        self.misses += 1
+        if entry is not None:
+            self.reused += 1
+        self._procs[pid] = [proc, now]
+        self.evict()
+        return proc
+
+    def scan(self):
+        """
+        Refresh all processes through the cache and return a Snapshot,
+        entries of exited processes are dropped
+        """
+        if not _procfs_available():
+            return snapshot()
+
+        timestamp = time.time()
+        pids = _pids()
+        alive = set(pids)
+        for pid in [pid for pid in self._procs if pid not in alive]:
+            del self._procs[pid]
+            self.evicted += 1
+
+        procs = []
+        vanished = unparsed = 0
+        for pid in pids:
+            try:
+                procs.append(self.get(pid))
+            except UnfoundException:
+                vanished += 1
+            except CMDOutException:
+                unparsed += 1
+        return Snapshot(procs, timestamp, time.time() - timestamp, vanished, unparsed)
+
+    def evict(self):
+        if self.ttl is not None:
+            expired = time.monotonic() - self.ttl
+            while self._procs and next(iter(self._procs.values()))[1] < expired:
+                self._procs.popitem(last=False)
+                self.evicted += 1
+        if self.maxsize is not None:
+            while len(self._procs) > self.maxsize:
+                self._procs.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        self._procs.clear()
+
+    def __len__(self):
+        return len(self._procs)
+
+    def __contains__(self, pid):
+        return pid in self._procs
+
+    def __repr__(self):
+        return "pps.ProcessCache(size={}, hits={}, misses={})".format(
+            len(self._procs), self.hits, self.misses)
+
+
+def watch_changes(interval=1, thresholds=None, ticks=None):
+    """
+    Yield a SnapshotDiff every interval seconds, with the processes
+    spawned, exited and changed (see Snapshot.diff) since the last tick.
+    The first diff has every running process as spawned.
+
+    Processes are kept in a ProcessCache between ticks, so a tick reads
+    only the stat file of the known processes and all the files of the
+    spawned ones, and cpu is the usage since the previous tick.
+    """
+    cache = ProcessCache()
+    before = Snapshot([], time.time())
+    count = 0
+    deadline = time.monotonic()
+    while ticks is None or count < ticks:
+        snap = cache.scan()
+        diff = snap.diff(before, thresholds)
+        before = snap
+        count += 1
+        yield diff
+
+        deadline += interval
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            deadline = time.monotonic()
+
+
+class ProcessTree(object):
+    """
+    Parent/children index of the processes of a snapshot
+
+    The index is built from a single scan and updated in place by later
+    snapshots: only the processes which appeared, exited or changed parent
+    are touched. Processes whose parent is unknown, pid 1 and kernel
+    threads for instance, are roots.
+    """
+    def __init__(self, snap=None):
+        self.processes = {}  # pid -> process
+        self._parents  = {}  # pid -> ppid
+        self._children = {}  # ppid -> set of pids
+        self.timestamp = None
+        self._cache    = None
+        if snap is not None:
+            self.update(snap)
+
+    @classmethod
+    def scan(cls):
+        tree = cls()
+        tree.refresh()
+        return tree
+
+    def refresh(self):
+        """
+        Rescan the process table through a ProcessCache owned by the tree,
+        so that static fields are not parsed again, and update the index
+        """
+        if self._cache is None:
+            self._cache = ProcessCache()
+        self.update(self._cache.scan())
+
+    def _link(self, pid, ppid):
+        self._parents[pid] = ppid
+        self._children.setdefault(ppid, set()).add(pid)
+
+    def _unlink(self, pid):
+        ppid = self._parents.pop(pid)
+        siblings = self._children.get(ppid)
+        if siblings is not None:
+            siblings.discard(pid)
+            if not siblings:
+                del self._children[ppid]
+
+    def update(self, snap):
+        """Apply a newer snapshot to the index"""
+        current = dict((p.pid, p) for p in snap)
+        for pid, proc in list(self.processes.items()):
+            new = current.get(pid)
+            if new is None or new.ident != proc.ident:
+                self._unlink(pid)
+                del self.processes[pid]
+
+        for pid, proc in current.items():
+            if pid not in self.processes:
+                self._link(pid, proc.ppid)
+            elif self._parents[pid] != proc.ppid:
+                self._unlink(pid)
+                self._link(pid, proc.ppid)
+            self.processes[pid] = proc
+        self.timestamp = snap.timestamp
+
+    def get(self, pid, default=None):
+        return self.processes.get(pid, default)
+
+    def roots(self):
+        return [p for pid, p in self.processes.items()
+                if self._parents[pid] not in self.processes]
+
+    def children(self, pid):
+        return [self.processes[c] for c in self._children.get(pid, ())]
+
+    def descendants(self, pid):
+        """All processes below pid, in breadth first order"""
+        result = []
+        queue = deque(self._children.get(pid, ()))
+        while queue:
+            child = queue.popleft()
+            result.append(self.processes[child])
+            queue.extend(self._children.get(child, ()))
+        return result
+
+    def ancestors(self, pid):
+        """The parent of pid, its parent and so on up to a root"""
+        result = []
+        seen = set([pid])
+        ppid = self._parents.get(pid)
+        while ppid in self.processes and ppid not in seen:
+            seen.add(ppid)
+            result.append(self.processes[ppid])
+            ppid = self._parents.get(ppid)
+        return result
+
+    def subtree(self, pid):
+        """The process of pid followed by all its descendants"""
+        if pid not in self.processes:
+            raise UnfoundException("process %d not found" % pid)
+        return [self.processes[pid]] + self.descendants(pid)
+
+    def subtree_sum(self, pid, fields=("rss", "cpu", "vsz")):
+        """
+        Sum fields over pid and all its descendants, return a dict. The cpu
+        field is summed from Process.cpu_percent(), the usage since the
+        previous refresh when the tree is refreshed.
+        """
+        sums = dict((name, 0) for name in fields)
+        for proc in self.subtree(pid):
+            for name in fields:
+                value = proc.cpu_percent() if name == "cpu" else getattr(proc, name)
+                sums[name] += value or 0
+        return sums
+
+    def __len__(self):
+        return len(self.processes)
+
+    def __contains__(self, pid):
+        return pid in self.processes
+
+    def __repr__(self):
+        return "pps.ProcessTree(processes={}, roots={})".format(
+            len(self.processes), len(self.roots()))
+
+
+def mem_percent():
+    return _mem_percent(_read(os.path.join(PROC_ROOT, "meminfo")))
+
+def cpu_percent():
+    def cputimes():
+        with open(os.path.join(PROC_ROOT, "stat")) as f:
+            cpuinfo = [float(x) for x in f.readline().split()[1:]]
+            total_cputime = sum(cpuinfo)
+            idle_cputime = cpuinfo[3]
+
+        return total_cputime, idle_cputime
+
+    total_cputime_1, idle_cputime_1 = cputimes()
+    time.sleep(0.1)
+    total_cputime_2, idle_cputime_2 = cputimes()
+    total_cputime = total_cputime_2 - total_cputime_1
+    idle_cputime = idle_cputime_2 - idle_cputime_1
+    percent = ((total_cputime - idle_cputime) / total_cputime) * 100
+    return round(percent, 2)
+
+
+
+CpuPercent = namedtuple("CpuPercent", ["total", "user", "nice", "system", "idle",
+                                       "iowait", "irq", "softirq", "steal"])
+
+
+class CpuSampler(object):
+    """
+    Non-blocking CPU utilization sampler
+
+    The sampler keeps the counters of /proc/stat read by the previous
+    call, so sample() returns the utilization since the last call (or
+    since the creation of the sampler) without sleeping. As cpu_percent()
+    does, total is the percentage of time not spent idle.
+    """
+    FIELDS = CpuPercent._fields[1:]
+
+    def __init__(self, stat=None, per_cpu=True):
+        # An open _ProcFile of /proc/stat, or None to open it on each read
+        self._stat = stat
+        self._per_cpu = per_cpu
+        self.timestamp = time.time()
+        self._counters = self._read()
+        # Until there are two reads, report the utilization since boot
+        self.last = self._percent(self._counters[0], [0] * len(self.FIELDS))
+        self.percpu = [self._percent(c, [0] * len(self.FIELDS))
+                       for c in self._counters[1:]]
+
+    def _read(self):
+        if self._stat is None:
+            data = _read(os.path.join(PROC_ROOT, "stat"))
+        else:
+            data = self._stat.read(b"\nintr" if self._per_cpu else b"\ncpu0")
+        counters = []
+        for line in data.splitlines():
+            if not line.startswith(b"cpu") or counters and not self._per_cpu:
+                break
+            values = [int(v) for v in line.split()[1:len(self.FIELDS) + 1]]
+            values += [0] * (len(self.FIELDS) - len(values))
+            counters.append(values)
+        return counters
+
+    def _percent(self, current, previous):
+        deltas = [max(c - p, 0) for c, p in zip(current, previous)]
+        total = sum(deltas)
+        if total == 0:
+            return None
+        percents = [round(d * 100.0 / total, 2) for d in deltas]
+        return CpuPercent(round(100 - deltas[3] * 100.0 / total, 2), *percents)
+
+    def sample(self):
+        """
+        Return the CpuPercent of all CPUs since the previous sample, the
+        per-CPU values are stored in the percpu attribute
+        """
+        counters = self._read()
+        self.timestamp = time.time()
+        total = self._percent(counters[0], self._counters[0])
+        if total is not None:
+            self.last = total
+        percpu = []
+        for i, current in enumerate(counters[1:]):
+            previous = self._counters[i + 1] if i + 1 < len(self._counters) else current
+            percent = self._percent(current, previous)
+            if percent is None and i < len(self.percpu):
+                percent = self.percpu[i]
+            percpu.append(percent)
+        self.percpu = percpu
+        self._counters = counters
+        return self.last
+
+
+Pressure = namedtuple("Pressure", ["avg10", "avg60", "avg300", "total"])
+
+
+class SystemSample(object):
+    """
+    System-wide values shared by all the processes checked in a watch tick
+
+    meminfo maps the sampled /proc/meminfo keys to their values in kB,
+    loadavg is the 1, 5 and 15 minutes load average, and pressure maps
+    each resource of /proc/pressure to {"some": Pressure, "full": Pressure}.
+    """
+    def __init__(self, timestamp, mem_percent, cpu, percpu=None, meminfo=None,
+                 loadavg=None, pressure=None):
+        self.timestamp   = timestamp
+        self.mem_percent = mem_percent
+        self.cpu         = cpu
+        self.percpu      = percpu
+        self.meminfo     = meminfo or {}
+        self.loadavg     = loadavg
+        self.pressure    = pressure or {}
+
+    @property
+    def cpu_percent(self):
+        return self.cpu.total
+
+    def __repr__(self):
+        return "pps.SystemSample(mem_percent={}, cpu_percent={})".format(
+            self.mem_percent, self.cpu_percent)
+
+
+def _parse_pressure(data):
+    pressure = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) == 5:
+            pressure[fields[0].decode()] = Pressure(
+                float(fields[1][6:]), float(fields[2][6:]),
+                float(fields[3][7:]), int(fields[4][6:]))
+    return pressure
+
+
+class SystemSampler(object):
+    """
+    System-wide sampler for high-frequency sampling
+
+    The sampler keeps /proc/meminfo, /proc/stat, /proc/loadavg and the
+    files of /proc/pressure open and re-reads them into reused buffers,
+    so a sample costs one pread per file and no open or close. Only the
+    meminfo keys asked for are parsed. Pressure files which cannot be
+    opened or read (kernels without PSI) are left out of the samples.
+    """
+    MEMINFO = ("MemTotal", "MemFree", "MemAvailable", "Buffers", "Cached",
+               "SwapTotal", "SwapFree")
+    PRESSURE = ("cpu", "memory", "io")
+
+    def __init__(self, meminfo=MEMINFO, loadavg=True, pressure=True, percpu=False):
+        self.meminfo_keys = list(meminfo)
+        self.percpu = percpu
+        self.last = None
+        self._keys = [key.encode() for key in self.meminfo_keys]
+        self._meminfo = _ProcFile(os.path.join(PROC_ROOT, "meminfo"))
+        self._cpu = CpuSampler(_ProcFile(os.path.join(PROC_ROOT, "stat")), percpu)
+        self._loadavg = _ProcFile(os.path.join(PROC_ROOT, "loadavg"), 256) if loadavg else None
+        self._pressure = OrderedDict()
+        for name in (self.PRESSURE if pressure else ()):
+            try:
+                self._pressure[name] = _ProcFile(os.path.join(PROC_ROOT, "pressure", name), 256)
+            except OSError:
+                pass
+
+    def sample(self):
+        """Return a SystemSample of the current values"""
+        timestamp = time.time()
+        data = self._meminfo.read()
+        meminfo = dict((name, _meminfo_value(data, key))
+                       for name, key in zip(self.meminfo_keys, self._keys))
+        cpu = self._cpu.sample()
+
+        loadavg = None
+        if self._loadavg is not None:
+            loadavg = tuple(float(v) for v in self._loadavg.read().split()[:3])
+
+        pressure = {}
+        for name, f in list(self._pressure.items()):
+            try:
+                pressure[name] = _parse_pressure(f.read())
+            except OSError:
+                f.close()
+                del self._pressure[name]
+
+        self.last = SystemSample(timestamp, _mem_percent(data), cpu,
+                                 self._cpu.percpu if self.percpu else None,
+                                 meminfo, loadavg, pressure)
+        return self.last
+
+    def close(self):
+        files = [self._meminfo, self._cpu._stat, self._loadavg]
+        for f in files + list(self._pressure.values()):
+            if f is not None:
+                f.close()
+        self._pressure.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _cgroup2_root():
+    if os.path.isfile(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        return CGROUP_ROOT
+    unified = os.path.join(CGROUP_ROOT, "unified")
+    if os.path.isfile(os.path.join(unified, "cgroup.controllers")):
+        return unified
+    raise UnfoundException("cgroup v2 hierarchy not found below %s" % CGROUP_ROOT)
+
+
+def _parse_keyed(data):
+    values = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            values[fields[0].decode()] = int(fields[1])
+    return values
+
+
+class CgroupSample(object):
+    """
+    Values of a cgroup at one time
+
+    Memory values are in bytes, memory_max and memory_high are None when
+    unlimited, and memory_percent is memory_current in percent of
+    memory_max, or of the total memory without a limit. cpu_percent is the
+    usage of the group since the previous sample in percent of one CPU,
+    as ps reports it, cpu_limit the number of CPUs cpu.max allows (None
+    when unlimited) and cpu_limit_percent the usage in percent of the
+    limit, or of all CPUs. events holds the memory.events counters and
+    events_delta their increase since the previous sample.
+    """
+    def __init__(self, timestamp, memory_current, memory_max, memory_high,
+                 memory_percent, cpu_percent, cpu_limit, cpu_limit_percent,
+                 throttled, events, events_delta, pressure):
+        self.timestamp         = timestamp
+        self.memory_current    = memory_current
+        self.memory_max        = memory_max
+        self.memory_high       = memory_high
+        self.memory_percent    = memory_percent
+        self.cpu_percent       = cpu_percent
+        self.cpu_limit         = cpu_limit
+        self.cpu_limit_percent = cpu_limit_percent
+        self.throttled         = throttled
+        self.events            = events
+        self.events_delta      = events_delta
+        self.pressure          = pressure
+
+    def __repr__(self):
+        return "pps.CgroupSample(memory_percent={}, cpu_percent={})".format(
+            self.memory_percent, self.cpu_percent)
+
+
+class Cgroup(object):
+    """
+    Aggregate accounting of a cgroup v2 group
+
+    path is the path of the group in the hierarchy, as /proc/<pid>/cgroup
+    shows it ("/system.slice/nginx.service"), Cgroup.of_pid(pid) reads it
+    for a process. A sample costs a few small file reads however many
+    processes the group has. Files of controllers which are not enabled
+    for the group read as None.
+    """
+    def __init__(self, path="/"):
+        self.path = "/" + path.strip("/")
+        self.dir = os.path.join(_cgroup2_root(), self.path.lstrip("/"))
+        if not os.path.isdir(self.dir):
+            raise UnfoundException("cgroup %s not found" % self.path)
+        self.last = None
+        self._cpu_usage = None
+        self._throttled = None
+        self._events = None
+
+    @staticmethod
+    def path_of(pid):
+        """Return the cgroup v2 path of pid, as of_pid() looks it up"""
+        try:
+            data = _read(os.path.join(PROC_ROOT, str(pid), "cgroup"))
+        except (IOError, OSError):
+            raise UnfoundException("process %s not found" % pid)
+        for line in data.splitlines():
+            if line.startswith(b"0::"):
+                return line[3:].decode()
+        raise UnfoundException("process %s is in no cgroup v2 group" % pid)
+
+    @classmethod
+    def of_pid(cls, pid):
+        return cls(cls.path_of(pid))
+
+    def _read(self, name):
+        try:
+            return _read(os.path.join(self.dir, name))
+        except (IOError, OSError) as err:
+            if err.errno in (errno.ENOENT, errno.ENODEV, errno.EOPNOTSUPP):
+                return None
+            raise
+
+    def _read_int(self, name):
+        data = self._read(name)
+        if data is None:
+            return None
+        data = data.strip()
+        return None if data == b"max" else int(data)
+
+    def memory_current(self):
+        return self._read_int("memory.current")
+
+    def memory_max(self):
+        return self._read_int("memory.max")
+
+    def memory_high(self):
+        return self._read_int("memory.high")
+
+    def memory_stat(self):
+        data = self._read("memory.stat")
+        return None if data is None else _parse_keyed(data)
+
+    def memory_events(self):
+        data = self._read("memory.events")
+        return None if data is None else _parse_keyed(data)
+
+    def cpu_stat(self):
+        data = self._read("cpu.stat")
+        return None if data is None else _parse_keyed(data)
+
+    def cpu_max(self):
+        """Return (quota, period) in microseconds, quota is None if unlimited"""
+        data = self._read("cpu.max")
+        if data is None:
+            return None
+        quota, period = data.split()
+        return (None if quota == b"max" else int(quota)), int(period)
+
+    def pressure(self, resource):
+        """{"some": Pressure, "full": Pressure} of cpu, memory or io"""
+        data = self._read(resource + ".pressure")
+        return None if data is None else _parse_pressure(data)
+
+    def procs(self):
+        data = self._read("cgroup.procs")
+        return [] if data is None else [int(pid) for pid in data.split()]
+
+    def sample(self):
+        """
+        Return a CgroupSample, the deltas are taken from the previous
+        sample and are None in the first one
+        """
+        now = time.monotonic()
+        current = self.memory_current()
+        limit = self.memory_max()
+        total = limit or _proc_const("memtotal") * 1024
+        memory_percent = None
+        if current is not None and total:
+            memory_percent = round(current * 100.0 / total, 2)
+
+        cpu_percent = cpu_limit = cpu_limit_percent = throttled = None
+        stat = self.cpu_stat()
+        if stat is not None:
+            usage = stat["usage_usec"]
+            if self._cpu_usage is not None and now > self._cpu_usage[1]:
+                delta = max(usage - self._cpu_usage[0], 0)
+                cpu_percent = round(delta / 1e4 / (now - self._cpu_usage[1]), 2)
+            self._cpu_usage = usage, now
+            if "throttled_usec" in stat:
+                if self._throttled is not None:
+                    throttled = max(stat["throttled_usec"] - self._throttled, 0) / 1e6
+                self._throttled = stat["throttled_usec"]
+        quota = self.cpu_max()
+        if quota is not None and quota[0] is not None:
+            cpu_limit = quota[0] / quota[1]
+        if cpu_percent is not None:
+            cpu_limit_percent = round(cpu_percent / (cpu_limit or os.cpu_count() or 1), 2)
+
+        events = self.memory_events()
+        events_delta = None
+        if events is not None and self._events is not None:
+            events_delta = dict((k, v - self._events.get(k, 0)) for k, v in events.items())
+        self._events = events
+
+        pressure = {}
+        for resource in ("cpu", "memory"):
+            value = self.pressure(resource)
+            if value is not None:
+                pressure[resource] = value
+
+        self.last = CgroupSample(time.time(), current, limit, self.memory_high(),
+                                 memory_percent, cpu_percent, cpu_limit,
+                                 cpu_limit_percent, throttled, events,
+                                 events_delta, pressure)
+        return self.last
+
+    def __repr__(self):
+        return "pps.Cgroup({})".format(self.path)
+
+
+class MemRule(object):
+    """
+    Match a process using more than limit percent of memory while the
+    whole system uses more than system_limit percent
+
+    With accurate, the memory of the process is its pss, which does not
+    count the pages it shares with other processes in full. Since pss is
+    never above rss, the cheap rss check runs first and smaps_rollup is
+    only read, at most every SMAPS_MAX_AGE seconds, for the processes
+    which fail it.
+    """
+    def __init__(self, limit=50, system_limit=90, accurate=False):
+        self.limit = limit
+        self.system_limit = system_limit
+        self.accurate = accurate
+
+    def __call__(self, proc, system):
+        if proc.mem <= self.limit or system.mem_percent <= self.system_limit:
+            return None
+        if not self.accurate:
+            return "mem %.1f%% > %s%%" % (proc.mem, self.limit)
+        age = proc.smaps_age()
+        if age is None or age >= SMAPS_MAX_AGE:
+            proc.refresh("smaps")
+        if proc.pss is None:
+            # smaps_rollup may not be read by this user, rss is all there is
+            return "mem %.1f%% > %s%%" % (proc.mem, self.limit)
+        mem = proc.pss * 100.0 / _proc_const("memtotal")
+        if mem > self.limit:
+            return "pss %.1f%% > %s%%" % (mem, self.limit)
+
+
+class CpuRule(object):
+    """
+    Match a process using more than limit percent of CPU since the last
+    tick while the whole system uses more than system_limit percent
+    """
+    def __init__(self, limit=50, system_limit=90):
+        self.limit = limit
+        self.system_limit = system_limit
+
+    def __call__(self, proc, system):
+        cpu = proc.cpu_percent()
+        if cpu > self.limit and system.cpu_percent > self.system_limit:
+            return "cpu %.1f%% > %s%%" % (cpu, self.limit)
+
+
+class RateRule(object):
+    """
+    Match a process whose rate field (read_rate, write_rate,
+    read_count_rate, write_count_rate, voluntary_ctxt_rate or
+    nonvoluntary_ctxt_rate) is above limit per second, for example
+    RateRule("write_rate", 50 << 20) for more than 50MB/s of writes
+
+    A Watcher loads the group of the field when a process is added, then
+    every tick refreshes it in the same pass as the other fields.
+    """
+    def __init__(self, field, limit):
+        if field not in _rate_fields:
+            raise ValueError("unknown rate field: %s" % field)
+        self.field  = field
+        self.limit  = limit
+        self.groups = ([name for name, group in _group_names.items()
+                        if group == _rate_fields[field][0]])
+
+    def __call__(self, proc, system):
+        rate = getattr(proc, self.field)
+        if rate is not None and rate > self.limit:
+            return "%s %.1f/s > %s/s" % (self.field, rate, self.limit)
+
+
+class CgroupRule(object):
+    """
+    Match a process whose cgroup uses more than limit percent of its
+    memory limit (resource "memory") or of its CPU quota ("cpu")
+
+    The group of a process is looked up every tick, so a process moved to
+    another group is followed, and each group is sampled once per tick
+    however many watched processes share it. Groups no process was in
+    during the previous tick are dropped.
+    """
+    def __init__(self, limit=90, resource="memory"):
+        if resource not in ("memory", "cpu"):
+            raise ValueError("resource must be memory or cpu")
+        self.limit    = limit
+        self.resource = resource
+        self._groups  = {}   # cgroup path -> [Cgroup, sample, system timestamp]
+        self._tick    = None
+
+    def _sample(self, proc, system):
+        if system.timestamp != self._tick:
+            self._groups = dict((path, entry) for path, entry in self._groups.items()
+                                if entry[2] == self._tick)
+            self._tick = system.timestamp
+        path = Cgroup.path_of(proc.pid)
+        entry = self._groups.get(path)
+        if entry is None:
+            entry = self._groups[path] = [Cgroup(path), None, None]
+        if entry[2] != system.timestamp:
+            entry[1] = entry[0].sample()
+            entry[2] = system.timestamp
+        return entry[0], entry[1]
+
+    def __call__(self, proc, system):
+        try:
+            group, sample = self._sample(proc, system)
+        except UnfoundException:
+            return None
+        if self.resource == "memory":
+            value = sample.memory_percent
+        else:
+            value = sample.cpu_limit_percent
+        if value is not None and value > self.limit:
+            return "cgroup %s %s %.1f%% > %s%%" % (group.path, self.resource, value, self.limit)
+
+
+class RingBuffer(object):
+    """
+    Fixed size buffer of numbers kept in a typed array, appending is O(1)
+    and overwrites the oldest value once the buffer is full
+    """
+    __slots__ = ("_data", "_pos", "_count")
+
+    def __init__(self, size, typecode="d"):
+        self._data  = array(typecode, [0]) * size
+        self._pos   = 0
+        self._count = 0
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def append(self, value):
+        self._data[self._pos] = value
+        self._pos = (self._pos + 1) % len(self._data)
+        if self._count < len(self._data):
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        """Index 0 is the oldest value, -1 the newest"""
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("ring buffer index out of range")
+        return self._data[(self._pos - self._count + index) % len(self._data)]
+
+    def last(self, n=None):
+        """The newest n values (all of them by default), oldest first"""
+        n = self._count if n is None else min(n, self._count)
+        start = (self._pos - n) % len(self._data)
+        if start + n <= len(self._data):
+            return self._data[start:start + n].tolist()
+        return (self._data[start:] + self._data[:self._pos]).tolist()
+
+    def clear(self):
+        self._pos = 0
+        self._count = 0
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100.0
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+class History(object):
+    """
+    Recent cpu, mem and rss samples of processes
+
+    Each process has one fixed size ring buffer per field plus one for the
+    sample times, so the memory used per process does not grow however
+    long the history is recorded. Queries take a window in seconds, which
+    ends at the newest sample of the process; cpu is Process.cpu_percent().
+    """
+    FIELDS = ("cpu", "mem", "rss")
+
+    def __init__(self, size=600):
+        self.size = size
+        self._series = {}  # pid -> [ident, times, {field: buffer}]
+
+    def record(self, proc, timestamp=None):
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        series = self._series.get(proc.pid)
+        if series is None or series[0] != proc.ident:
+            series = [proc.ident, RingBuffer(self.size),
+                      dict((name, RingBuffer(self.size)) for name in self.FIELDS)]
+            self._series[proc.pid] = series
+        series[1].append(timestamp)
+        buffers = series[2]
+        buffers["cpu"].append(proc.cpu_percent())
+        buffers["mem"].append(proc.mem)
+        buffers["rss"].append(proc.rss)
+
+    def forget(self, pid):
+        self._series.pop(pid, None)
+
+    def __contains__(self, pid):
+        return pid in self._series
+
+    def __len__(self):
+        return len(self._series)
+
+    def window(self, pid, field, seconds=None):
+        """
+        Return (times, values) of the samples of pid in the last seconds,
+        oldest first
+        """
+        series = self._series.get(pid)
+        if series is None:
+            return [], []
+        times, values = series[1], series[2][field]
+        n = len(times)
+        if seconds is not None and n:
+            start = times[-1] - seconds
+            count = 0
+            while count < n and times[-count - 1] >= start:
+                count += 1
+            n = count
+        return times.last(n), values.last(n)
+
+    def mean(self, pid, field, seconds=None):
+        values = self.window(pid, field, seconds)[1]
+        return sum(values) / len(values) if values else None
+
+    def max(self, pid, field, seconds=None):
+        values = self.window(pid, field, seconds)[1]
+        return max(values) if values else None
+
+    def min(self, pid, field, seconds=None):
+        values = self.window(pid, field, seconds)[1]
+        return min(values) if values else None
+
+    def percentile(self, pid, field, q, seconds=None):
+        """The q-th percentile (0-100) of the field, linearly interpolated"""
+        return _percentile(self.window(pid, field, seconds)[1], q)
+
+    def rate(self, pid, field, seconds=None):
+        """Change of the field per second over the window"""
+        times, values = self.window(pid, field, seconds)
+        if len(times) < 2 or times[-1] == times[0]:
+            return None
+        return (values[-1] - values[0]) / (times[-1] - times[0])
+
+    def duration_above(self, pid, field, limit):
+        """
+        Seconds since the field has been above limit without interruption,
+        0 if its newest sample is not above it
+        """
+        series = self._series.get(pid)
+        if series is None or not len(series[1]):
+            return 0.0
+        times, values = series[1], series[2][field]
+        since = None
+        for i in range(len(times) - 1, -1, -1):
+            if values[i] <= limit:
+                break
+            since = times[i]
+        return 0.0 if since is None else times[-1] - since
+
+
+class SustainedRule(object):
+    """
+    Match a process whose field has stayed above limit for at least
+    duration seconds, for example rss above 1GB for 30s
+    """
+    def __init__(self, history, field, limit, duration):
+        self.history  = history
+        self.field    = field
+        self.limit    = limit
+        self.duration = duration
+
+    def __call__(self, proc, system):
+        above = self.history.duration_above(proc.pid, self.field, self.limit)
+        if above >= self.duration:
+            return "%s > %s for %.0fs" % (self.field, self.limit, above)
+
+
+class GrowthRule(object):
+    """
+    Match a process whose field grows faster than limit per minute over
+    the last window seconds, for example rss growth above 100MB/min
+    """
+    def __init__(self, history, field, limit, window=60):
+        self.history = history
+        self.field   = field
+        self.limit   = limit
+        self.window  = window
+
+    def __call__(self, proc, system):
+        times = self.history.window(proc.pid, self.field, self.window)[0]
+        if not times or times[-1] - times[0] < self.window / 2.0:
+            return None  # not enough history yet
+        rate = self.history.rate(proc.pid, self.field, self.window)
+        if rate is not None and rate * 60 > self.limit:
+            return "%s growth %.1f/min > %s/min" % (self.field, rate * 60, self.limit)
+
+
+def _log():
+    # logging is only imported when there is something to log
+    import logging
+    return logging.getLogger("pps")
+
+
+class Watcher(object):
+    """
+    Watch a set of processes and check them against rules every interval
+
+    Each tick takes one system-wide sample, refreshes all watched processes
+    in one batch and evaluates the rules against the shared sample, so the
+    cost of a tick only grows with the per-pid procfs reads. A rule is a
+    callable taking (process, system_sample) and returning a reason string
+    when the process violates it. Violating processes are passed to
+    action(process, reason) and no longer watched, processes which exited
+    are passed to on_exit(pid). With a History, every refreshed process is
+    recorded into it before the rules are checked.
+
+    The time of the last tick is kept in tick_cost, how late it started
+    compared to its schedule in lag, and the largest lag in max_lag.
+
+    A tick holds lock while it refreshes and checks the processes, other
+    threads hold it too to change the watched processes or the rules
+    between ticks. action and on_exit are called after it is released.
+
+    The watcher keeps the system files open between ticks, close() or a
+    with statement releases them.
+    """
+    def __init__(self, pids=(), interval=1, rules=None, action=None, on_exit=None,
+                 history=None):
+        self.interval  = interval
+        self.history   = history
+        self.rules     = [MemRule(), CpuRule()] if rules is None else list(rules)
+        self.action    = action
+        self.on_exit   = on_exit
+        self.processes = OrderedDict()
+        self.system    = None
+        self.ticks     = 0
+        self.tick_cost = 0.0
+        self.lag       = 0.0
+        self.max_lag   = 0.0
+        self.lock      = threading.RLock()
+        self._sampler  = SystemSampler()
+        for pid in pids:
+            self.add(pid)
+
+    def add(self, pid):
+        pid = int(pid)
+        if pid not in self.processes:
+            proc = Process(pid)
+            # Groups the rules need beyond the default ones (rule.groups),
+            # loaded now so that update() refreshes them every tick
+            groups = set(g for rule in self.rules for g in getattr(rule, "groups", ()))
+            if groups:
+                proc.refresh(*groups)
+            self.processes[pid] = proc
+        return self.processes[pid]
+
+    def remove(self, pid):
+        if self.history is not None:
+            self.history.forget(int(pid))
+        return self.processes.pop(int(pid), None)
+
+    def sample_system(self):
+        self.system = self._sampler.sample()
+        return self.system
+
+    def close(self):
+        """Close the procfs files kept open by the system sampler"""
+        self._sampler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def check(self, proc, system):
+        for rule in self.rules:
+            reason = rule(proc, system)
+            if reason:
+                return reason
+
+    @staticmethod
+    def _call(func, *args):
+        try:
+            func(*args)
+        except Exception:
+            _log().exception("watcher callback %r failed", func)
+
+    def tick(self):
+        """
+        Refresh and check every watched process once, return the list of
+        (process, reason) violations. A rule, action or on_exit which
+        raises is logged and does not stop the tick.
+        """
+        started = time.monotonic()
+        violations = []
+        exited = []
+        with self.lock:
+            system = self.sample_system()
+            for pid, proc in self.processes.items():
+                try:
+                    proc.update()
+                except (UnfoundException, CMDOutException):
+                    exited.append(pid)
+                    continue
+                if self.history is not None:
+                    self.history.record(proc)
+                try:
+                    reason = self.check(proc, system)
+                except UnfoundException:
+                    # The process exited between update() and its rules
+                    exited.append(pid)
+                    continue
+                except Exception:
+                    _log().exception("rule failed on process %d", pid)
+                    continue
+                if reason:
+                    violations.append((proc, reason))
+            for pid in exited:
+                self.remove(pid)
+            for proc, reason in violations:
+                self.remove(proc.pid)
+
+        for pid in exited:
+            if self.on_exit is not None:
+                self._call(self.on_exit, pid)
+        for proc, reason in violations:
+            if self.action is not None:
+                self._call(self.action, proc, reason)
+
+        self.ticks += 1
+        self.tick_cost = time.monotonic() - started
+        return violations
+
+    def run(self, ticks=None):
+        """
+        Tick every interval until no process is left to watch, or the given
+        number of ticks have run. Ticks are scheduled at fixed times, a tick
+        which starts late is recorded in lag and missed ticks are skipped.
+        """
+        count = 0
+        deadline = time.monotonic()
+        while self.processes and (ticks is None or count < ticks):
+            self.lag = max(time.monotonic() - deadline, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            self.tick()
+            count += 1
+
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif -delay > self.interval:
+                deadline += (-delay // self.interval) * self.interval
+
+    async def arun(self, ticks=None):
+        """
+        Asynchronous version of run(), ticks run in the pps executor so the
+        event loop is never blocked by procfs reads or actions
+        """
+        import asyncio
+        count = 0
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while self.processes and (ticks is None or count < ticks):
+            self.lag = max(loop.time() - deadline, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            await _run_blocking(self.tick)
+            count += 1
+
+            deadline += self.interval
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif -delay > self.interval:
+                deadline += (-delay // self.interval) * self.interval
+
+
+def _label(value):
+    return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _process_name(proc):
+    if proc._comm is not None:
+        return proc._comm
+    cmd = proc.cmd.split()
+    return os.path.basename(cmd[0]) if cmd else ""
+
+
+class Exporter(object):
+    """
+    OpenMetrics exporter of the system metrics and of selected processes
+
+    The processes are selected by the keyword arguments of processes(),
+    all processes are exported when there is none. A scrape renders the
+    cached metrics when they are younger than max_age seconds, otherwise
+    it collects them again. Collection holds a lock, so scrapes which
+    arrive while one is running wait for it and then share its result:
+    the scan cost per max_age stays the same however many scrapers there
+    are.
+    """
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, address=("127.0.0.1", 9256), max_age=5, **filters):
+        self.address     = address
+        self.max_age     = max_age
+        self.filters     = filters
+        self.scrapes     = 0
+        self.collections = 0
+        self._lock       = threading.Lock()
+        self._sampler    = None
+        self._body       = None
+        self._collected  = None
+        self._server     = None
+        self._thread     = None
+
+    def _processes(self):
+        if self.filters:
+            return list(processes(**self.filters))
+        return snapshot().processes
+
+    def _collect(self):
+        started = time.monotonic()
+        if self._sampler is None:
+            self._sampler = SystemSampler()
+        system = self._sampler.sample()
+        procs = self._processes()
+
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("# HELP %s %s" % (name, help))
+            suffix = "_total" if kind == "counter" else ""
+            for labels, value in samples:
+                if labels:
+                    labels = "{%s}" % ",".join("%s=%s" % (k, _label(v)) for k, v in labels)
+                lines.append("%s%s%s %s" % (name, suffix, labels, value))
+
+        metric("pps_memory_used_percent", "gauge", "Percentage of memory in use",
+               [("", system.mem_percent)])
+        metric("pps_memory_bytes", "gauge", "Values of /proc/meminfo",
+               [((("field", k),), v * 1024) for k, v in sorted(system.meminfo.items())
+                if v is not None])
+        metric("pps_cpu_used_percent", "gauge",
+               "Percentage of CPU time not idle since the previous collection",
+               [("", system.cpu_percent)])
+        if system.loadavg is not None:
+            metric("pps_load_average", "gauge", "Load average",
+                   [((("period", p),), v) for p, v in zip(("1m", "5m", "15m"), system.loadavg)])
+        if system.pressure:
+            samples = []
+            for resource, kinds in sorted(system.pressure.items()):
+                for kind, pressure in sorted(kinds.items()):
+                    samples.append(((("resource", resource), ("kind", kind)),
+                                    pressure.total / 1e6))
+            metric("pps_pressure_stall_seconds", "counter",
+                   "Time some or all tasks stalled on a resource", samples)
+
+        rows = []
+        for p in procs:
+            try:
+                labels = (("pid", p.pid), ("user", p.user), ("name", _process_name(p)))
+                rows.append((labels, p.cpu, p._cputime, p.mem, p.rss, p.vsz))
+            except UnfoundException:
+                continue  # exited since it was listed
+        metric("pps_process_cpu_percent", "gauge",
+               "CPU usage of the process over its lifetime, as ps computes it",
+               [(row[0], row[1]) for row in rows])
+        metric("pps_process_cpu_seconds", "counter", "CPU time used by the process",
+               [(row[0], row[2]) for row in rows if row[2] is not None])
+        metric("pps_process_memory_percent", "gauge", "Memory usage of the process",
+               [(row[0], row[3]) for row in rows])
+        metric("pps_process_resident_memory_bytes", "gauge", "Resident set size",
+               [(row[0], row[4] * 1024) for row in rows])
+        metric("pps_process_virtual_memory_bytes", "gauge", "Virtual memory size",
+               [(row[0], row[5] * 1024) for row in rows])
+
+        self.collections += 1
+        metric("pps_exporter_processes", "gauge", "Processes in the last collection",
+               [("", len(rows))])
+        metric("pps_exporter_collections", "counter", "Collections of the metrics",
+               [("", self.collections)])
+        metric("pps_exporter_collect_seconds", "gauge", "Duration of the last collection",
+               [("", round(time.monotonic() - started, 6))])
+        lines.append("# EOF\n")
+        self._body = "\n".join(lines).encode("utf-8")
+        self._collected = time.monotonic()
+
+    def render(self):
+        """
+        Return the metrics in the OpenMetrics text format, collecting them
+        again only when the cached ones are older than max_age
+        """
+        with self._lock:
+            self.scrapes += 1
+            if self._collected is None or time.monotonic() - self._collected > self.max_age:
+                self._collect()
+            return self._body
+
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                try:
+                    body = exporter.render()
+                except Exception as err:
+                    self.send_error(500, str(err))
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _bind(self):
+        from http.server import ThreadingHTTPServer
+        self._server = ThreadingHTTPServer(self.address, self._handler())
+        self.address = self._server.server_address[:2]
+
+    def serve_forever(self):
+        """Serve the metrics at http://<address>/metrics until shutdown()"""
+        self._bind()
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve the metrics from a daemon thread, return the bound address"""
+        self._bind()
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="pps-exporter", daemon=True)
+        self._thread.start()
+        return self.address
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._sampler is not None:
+            self._sampler.close()
+            self._sampler = None
+
+
+# Self-instrumentation of the hot paths, see instrument()
+_stats = None
+_originals = []
+
+# Exceptions counted as parse errors of unexpected procfs or ps content
+_PARSE_ERRORS = (CMDOutException, ValueError, IndexError, KeyError)
+
+# Scans, which count the pids they skip in their result: the failures of
+# the timed calls they make are not counted again
+_SCAN_OPS = frozenset(["snapshot", "Scanner.snapshot", "ProcessTable.scan",
+                       "ProcessCache.scan"])
+_scanning = threading.local()
+
+# Timed operations: (owner, attribute name, operation name), owner None
+# is this module. processes.read times the read of one pid by processes()
+# and aprocesses().
+_TIMED = [
+    (None, "snapshot", "snapshot"),
+    (None, "mem_percent", "mem_percent"),
+    (None, "cpu_percent", "cpu_percent"),
+    ("Process", "update", "Process.update"),
+    ("Process", "refresh", "Process.refresh"),
+    ("_ProcessFilter", "read", "processes.read"),
+    ("Scanner", "snapshot", "Scanner.snapshot"),
+    ("ProcessTable", "scan", "ProcessTable.scan"),
+    ("ProcessCache", "scan", "ProcessCache.scan"),
+    ("CpuSampler", "sample", "CpuSampler.sample"),
+    ("SystemSampler", "sample", "SystemSampler.sample"),
+    ("Cgroup", "sample", "Cgroup.sample"),
+    ("Watcher", "tick", "Watcher.tick"),
+    ("Exporter", "render", "Exporter.render"),
+]
+
+
+class Histogram(object):
+    """
+    Latency histogram with power of two buckets, bucket i counts the
+    durations from 2 ** (i - 1) to 2 ** i microseconds
+    """
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    NBUCKETS = 32
+
+    def __init__(self):
+        self.count   = 0
+        self.total   = 0.0
+        self.min     = None
+        self.max     = None
+        self.buckets = array("L", [0] * self.NBUCKETS)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        i = int(seconds * 1e6).bit_length()
+        self.buckets[min(i, self.NBUCKETS - 1)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, q):
+        """
+        Upper bound in seconds of the bucket holding the q-th percentile
+        (0 to 100), bounded by the largest duration recorded
+        """
+        if not self.count:
+            return None
+        rank = max(self.count * q / 100, 1)
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(2 ** i / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "mean": self.mean,
+                "min": self.min, "max": self.max,
+                "p50": self.percentile(50), "p99": self.percentile(99)}
+
+    def __repr__(self):
+        return "pps.Histogram(count={}, mean={})".format(self.count, self.mean)
+
+
+class Stats(object):
+    """
+    Counters of the instrumented operations
+
+    ops maps each operation name to the Histogram of its durations,
+    reads and read_bytes count the procfs files read and their size,
+    vanished the pids which exited while being read and parse_errors the
+    operations which failed on unexpected content. errors keeps the last
+    failures of any kind as (operation, pid, error) and slowest the slowest calls
+    about one pid as (seconds, operation, pid), slowest first.
+    """
+    def __init__(self, slowest=10, errors=100):
+        self.lock         = threading.Lock()
+        self.hook         = None
+        self.ops          = {}
+        self.reads        = 0
+        self.read_bytes   = 0
+        self.vanished     = 0
+        self.parse_errors = 0
+        self.errors       = deque(maxlen=errors)
+        self._nslowest    = slowest
+        self._slowest     = []  # min-heap of (seconds, operation, pid)
+
+    def record(self, op, pid, start, seconds, error=None, count=True):
+        with self.lock:
+            hist = self.ops.get(op)
+            if hist is None:
+                hist = self.ops[op] = Histogram()
+            hist.record(seconds)
+            if pid is not None and self._nslowest:
+                item = (seconds, op, pid)
+                if len(self._slowest) < self._nslowest:
+                    heapq.heappush(self._slowest, item)
+                elif item > self._slowest[0]:
+                    heapq.heapreplace(self._slowest, item)
+            if error is not None:
+                if count and isinstance(error, UnfoundException):
+                    self.vanished += 1
+                elif count and isinstance(error, _PARSE_ERRORS):
+                    self.parse_errors += 1
+                self.errors.append((op, pid, error))
+        hook = self.hook
+        if hook is not None:
+            hook(op, pid, start, seconds, error)
+
+    def count_read(self, nbytes):
+        with self.lock:
+            self.reads += 1
+            self.read_bytes += nbytes
+
+    def count_skipped(self, vanished, unparsed):
+        if vanished or unparsed:
+            with self.lock:
+                self.vanished += vanished
+                self.parse_errors += unparsed
+
+    @property
+    def slowest(self):
+        return sorted(self._slowest, reverse=True)
+
+    def reset(self):
+        with self.lock:
+            self.ops = {}
+            self.reads = self.read_bytes = 0
+            self.vanished = self.parse_errors = 0
+            self.errors.clear()
+            self._slowest = []
+
+    def to_dict(self):
+        with self.lock:
+            return {"ops": {op: hist.to_dict() for op, hist in self.ops.items()},
+                    "reads": self.reads, "read_bytes": self.read_bytes,
+                    "vanished": self.vanished, "parse_errors": self.parse_errors,
+                    "errors": [(op, pid, repr(err)) for op, pid, err in self.errors],
+                    "slowest": self.slowest}
+
+    def __repr__(self):
+        return "pps.Stats(ops={}, reads={}, vanished={}, parse_errors={})".format(
+            len(self.ops), self.reads, self.vanished, self.parse_errors)
+
+
+def _timed(op, func, stats):
+    def wrapper(*args, **kwargs):
+        # The pid of the calls about one process
+        pid = getattr(args[0], "pid", None) if args else None
+        if pid is None and op == "processes.read" and len(args) > 1:
+            pid = args[1]
+        # Failures inside a scan are counted from its result, once, by the
+        # outermost scan, since the scan may run in other processes
+        nested = getattr(_scanning, "active", False)
+        scan = op in _SCAN_OPS and not nested
+        if scan:
+            _scanning.active = True
+        start = time.perf_counter()
+        error = None
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            if scan:
+                _scanning.active = False
+            stats.record(op, pid, start, time.perf_counter() - start, error, not nested)
+        if scan:
+            stats.count_skipped(result.vanished, result.unparsed)
+        return result
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def _instrumented(stats):
+    """Return the (owner, name, wrapper) to install"""
+    read, read_file = _read, _ProcFile.read
+
+    def counted_read(path):
+        data = read(path)
+        stats.count_read(len(data))
+        return data
+
+    def counted_read_file(self, stop=None):
+        data = read_file(self, stop)
+        stats.count_read(len(data))
+        return data
+
+    module = sys.modules[__name__]
+    wrappers = [(module, "_read", counted_read),
+                (_ProcFile, "read", counted_read_file)]
+    for owner, name, op in _TIMED:
+        owner = module if owner is None else getattr(module, owner)
+        func = owner.__dict__[name]
+        if isinstance(func, classmethod):
+            wrapper = classmethod(_timed(op, func.__func__, stats))
+        else:
+            wrapper = _timed(op, func, stats)
+        wrappers.append((owner, name, wrapper))
+    return wrappers
+
+
+def instrument(hook=None, slowest=10, errors=100):
+    """
+    Start counting the procfs reads and timing the hot paths of pps, and
+    return the Stats collecting the counters. hook, if given, is called
+    as hook(operation, pid, start, seconds, error) after each timed call,
+    start being a time.perf_counter() value, to emit spans or timers.
+
+    The functions and methods are replaced by counting wrappers, and put
+    back by uninstrument(), so pps costs nothing more while it is not
+    instrumented. Module functions imported by name before instrument()
+    are not timed, call them as pps.snapshot() and so on. Calling
+    instrument() again only replaces the hook.
+    """
+    global _stats
+    if _stats is None:
+        stats = Stats(slowest, errors)
+        for owner, name, wrapper in _instrumented(stats):
+            _originals.append((owner, name, owner.__dict__[name]))
+            setattr(owner, name, wrapper)
+        _stats = stats
+    _stats.hook = hook
+    return _stats
+
+
+def uninstrument():
+    """Put back the original functions, return the final Stats or None"""
+    global _stats
+    while _originals:
+        owner, name, func = _originals.pop()
+        setattr(owner, name, func)
+    stats, _stats = _stats, None
+    return stats
+
+
+def stats():
+    """Return the Stats of the running instrumentation, or None"""
+    return _stats
+
+
+# Bounded thread pool for the blocking work of the asynchronous API
+ASYNC_WORKERS = 4
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS,
+                                       thread_name_prefix="pps")
+    return _executor
+
+
+async def _run_blocking(func, *args):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), func, *args)
+
+
+def _read_processes(pids, filters):
+    procs = []
+    for pid in pids:
+        try:
+            p = filters.read(pid)
+        except (UnfoundException, CMDOutException):
+            continue
+        if p is not None:
+            procs.append(p)
+    return procs
+
+
+async def aprocesses(chunk_size=64, **filters):
+    """
+    Asynchronous version of processes(), which takes the same filters. The
+    processes are read in chunks of chunk_size pids by the pps executor.
+    """
+    if not _procfs_available():
+        for p in await _run_blocking(lambda: list(processes(**filters))):
+            yield p
+        return
+
+    filters = _ProcessFilter(**filters)
+    pids = await _run_blocking(_pids)
+    for i in range(0, len(pids), chunk_size):
+        chunk = pids[i:i + chunk_size]
+        for p in await _run_blocking(_read_processes, chunk, filters):
+            yield p
+
+
+async def asnapshot():
+    """Asynchronous version of snapshot()"""
+    return await _run_blocking(snapshot)
+
+
+async def acpu_percent(interval=0.1):
+    """
+    Asynchronous version of cpu_percent(), waits for interval seconds
+    without blocking the event loop. CpuSampler.sample() never blocks and
+    can be called from a coroutine directly.
+    """
+    import asyncio
+    sampler = CpuSampler()
+    await asyncio.sleep(interval)
+    return sampler.sample().total
 
 __version__ = 0.1
-__all__ = ["Process", "processes", "mem_percent", "cpu_percent"]
+__all__ = ["Process", "Snapshot", "Scanner", "ProcessTable", "ProcessCache",
+           "ProcessTree", "ThreadInfo", "SnapshotDiff", "CHANGE_THRESHOLDS",
+           "DIFF_FIELDS", "processes", "snapshot", "watch_changes",
+           "mem_percent", "cpu_percent", "CpuSampler", "CpuPercent",
+           "SystemSampler", "SystemSample", "Pressure", "Cgroup",
+           "CgroupSample", "Watcher", "MemRule", "CpuRule", "CgroupRule",
+           "RateRule", "RingBuffer", "History", "SustainedRule", "GrowthRule",
+           "Exporter", "Stats", "Histogram", "instrument", "uninstrument",
+           "stats", "aprocesses", "asnapshot", "acpu_percent"]
 
 
 # Script starts from here
@@ -22,4 +22,5 @@ setup(
     url="https://github.com/kuanghy/pps",
     description="Linux 'ps -aux' command wrapper.",
     license="MIT",
+    python_requires=">=3.7",
 )
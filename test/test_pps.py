@@ -12,9 +12,30 @@ from __future__ import print_function
 
 import os
 import sys
+import time
+import shutil
+import pytest
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "benchmark"))
+from contextlib import contextmanager
+
+import pps
 from pps import *
+from pps import UnfoundException
+from fakeproc import make_proc_root
+
+
+@contextmanager
+def fake_proc(root, nprocs):
+    pids = make_proc_root(root, nprocs)
+    proc_root = pps.PROC_ROOT
+    pps.PROC_ROOT = root
+    try:
+        yield pids
+    finally:
+        pps.PROC_ROOT = proc_root
+
 
 def test_mem_percent():
     print(mem_percent())
@@ -22,13 +43,732 @@ def test_mem_percent():
 def test_cpu_percent():
     print(cpu_percent())
 
-def test_class_process():
-    p = Process(4264)
-    print(p)
-    print(p.to_dict())
+def test_class_process(tmpdir):
+    with fake_proc(str(tmpdir), 10) as pids:
+        p = Process(pids[-1])
+        print(p)
+        print(p.to_dict())
+        assert p.cmd.endswith("--worker 9")
 
 def test_processes():
     for p in processes():
         print(p)
 
     print(list(processes()))
+
+def test_process_by_proc():
+    p = Process(os.getpid())
+    q = Process(os.getpid())
+    q._update_by_ps()
+    assert p.user == q.user
+    assert p.tty == q.tty
+    assert p.cmd.startswith(q.cmd)  # ps truncates to the terminal width
+    assert abs(p.vsz - q.vsz) < 10240
+
+def test_process_not_found():
+    try:
+        Process(2 ** 22 + 1)
+    except UnfoundException:
+        pass
+    else:
+        assert False
+
+def test_snapshot():
+    snap = snapshot()
+    assert len(snap) > 0
+    assert snap.vanished >= 0
+    assert os.getpid() in snap
+    assert snap.get(os.getpid()).cmd == Process(os.getpid()).cmd
+    print(snap)
+
+def test_snapshot_by_ps():
+    root = pps.PROC_ROOT
+    pps.PROC_ROOT = "/nonexistent"
+    try:
+        snap = snapshot()
+    finally:
+        pps.PROC_ROOT = root
+    assert os.getpid() in snap
+    assert snap.vanished == 0
+
+def _check_process_table():
+    table = ProcessTable.scan()
+    assert len(table) > 0
+    rss = sorted(table["rss"], reverse=True)
+    assert [r["rss"] for r in table.top(3, by="rss").to_dicts()] == list(rss[:3])
+    user = Process(os.getpid()).user
+    mine = table.select(table.user_mask(user), table.mask("rss", ">", 0))
+    assert os.getpid() in list(mine["pid"])
+    assert set(mine["user"]) == set([user])
+    assert table.sum_by_user("rss")[user] >= sum(mine["rss"])
+
+def test_process_table():
+    _check_process_table()
+
+def test_process_table_without_numpy():
+    np = pps._import_numpy()
+    pps.numpy = None
+    try:
+        _check_process_table()
+    finally:
+        pps.numpy = np
+
+def test_cpu_sampler():
+    sampler = CpuSampler()
+    assert 0 <= sampler.last.total <= 100
+    sum(range(1000000))
+    percent = sampler.sample()
+    assert 0 <= percent.total <= 100
+    assert abs(percent.total + percent.idle - 100) < 0.1
+    assert len(sampler.percpu) == os.cpu_count()
+
+def test_process_cpu_percent():
+    import time
+    p = Process(os.getpid())
+    assert p.cpu_percent() == p.cpu
+    deadline = time.time() + 0.2
+    while time.time() < deadline:
+        pass
+    p.update()
+    assert p.cpu_percent() > 20
+    assert p.cpu_percent(per_core=True) <= 100
+
+def test_system_sampler(tmpdir):
+    with SystemSampler(percpu=True) as sampler:
+        for _ in range(3):
+            sample = sampler.sample()
+        assert 0 < sample.mem_percent < 100
+        assert sample.meminfo["MemTotal"] > sample.meminfo["MemAvailable"] > 0
+        assert len(sample.loadavg) == 3
+        assert len(sample.percpu) == os.cpu_count()
+
+    with fake_proc(str(tmpdir), 10):
+        assert mem_percent() == 50.0
+        with SystemSampler(meminfo=("MemFree",)) as sampler:
+            sample = sampler.sample()
+        assert sample.mem_percent == 50.0
+        assert sample.meminfo == {"MemFree": 4 * 1024 * 1024}
+        assert sample.loadavg == (1.0, 0.5, 0.25)
+        assert sample.pressure["memory"]["some"] == Pressure(1.5, 1.0, 0.5, 123456)
+
+def test_exporter(tmpdir):
+    import threading
+    from urllib.request import urlopen
+
+    with fake_proc(str(tmpdir), 50):
+        exporter = Exporter(("127.0.0.1", 0), max_age=60, name="nginx")
+        host, port = exporter.start()
+        try:
+            bodies = []
+            def scrape():
+                with urlopen("http://%s:%d/metrics" % (host, port)) as resp:
+                    assert resp.headers["Content-Type"].startswith("application/openmetrics-text")
+                    bodies.append(resp.read().decode())
+            scrapers = [threading.Thread(target=scrape) for _ in range(8)]
+            for thread in scrapers:
+                thread.start()
+            for thread in scrapers:
+                thread.join()
+        finally:
+            exporter.shutdown()
+
+    assert exporter.scrapes == 8
+    assert exporter.collections == 1
+    assert len(set(bodies)) == 1
+    body = bodies[0]
+    assert body.endswith("# EOF\n")
+    assert "pps_memory_used_percent 50.0\n" in body
+    assert 'pps_pressure_stall_seconds_total{resource="cpu",kind="some"} 0.123456' in body
+    names = [line for line in body.splitlines()
+             if line.startswith("pps_process_resident_memory_bytes{")]
+    assert names and all('name="nginx"' in line for line in names)
+
+def test_cgroup(tmpdir):
+    def write(path, content):
+        path = os.path.join(str(tmpdir), path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    group = "unified/web.slice/nginx.service/"
+    write("unified/cgroup.controllers", "cpu memory io\n")
+    write(group + "memory.current", "%d\n" % (900 << 20))
+    write(group + "memory.max", "%d\n" % (1 << 30))
+    write(group + "memory.high", "max\n")
+    write(group + "memory.events", "low 0\nhigh 0\nmax 3\noom 1\noom_kill 1\n")
+    write(group + "memory.stat", "anon 104857600\nfile 52428800\n")
+    write(group + "cpu.max", "200000 100000\n")
+    write(group + "cpu.stat", "usage_usec 1000000\nthrottled_usec 5000\n")
+    write(group + "memory.pressure", "some avg10=2.00 avg60=1.00 avg300=0.50 total=42\n"
+                                     "full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n")
+    write(group + "cgroup.procs", "10\n12\n")
+    write("proc/10/cgroup", "1:name=systemd:/\n0::/web.slice/nginx.service\n")
+
+    old_roots = pps.CGROUP_ROOT, pps.PROC_ROOT
+    pps.CGROUP_ROOT, pps.PROC_ROOT = str(tmpdir), str(tmpdir.join("proc"))
+    try:
+        cgroup = Cgroup.of_pid(10)
+        assert cgroup.path == "/web.slice/nginx.service"
+        assert cgroup.procs() == [10, 12]
+        assert cgroup.memory_stat()["anon"] == 104857600
+        first = cgroup.sample()
+        assert first.memory_percent == 87.89
+        assert first.memory_high is None and first.cpu_limit == 2
+        assert first.cpu_percent is None
+        assert first.pressure["memory"]["some"].total == 42
+        assert "cpu" not in first.pressure
+
+        write(group + "cpu.stat", "usage_usec 1500000\nthrottled_usec 7000\n")
+        write(group + "memory.events", "low 0\nhigh 0\nmax 5\noom 1\noom_kill 2\n")
+        second = cgroup.sample()
+        assert second.cpu_percent > 0 and second.throttled == 0.002
+        assert second.events_delta["oom_kill"] == 1
+
+        class Proc(object):
+            pid, ident = 10, (10, 1)
+        system = SystemSample(time.time(), 10, None)
+        assert CgroupRule(80)(Proc(), system) == \
+            "cgroup /web.slice/nginx.service memory 87.9% > 80%"
+        assert CgroupRule(90)(Proc(), system) is None
+
+        write("unified/batch.slice/memory.current", "%d\n" % (1 << 20))
+        write("unified/batch.slice/memory.max", "%d\n" % (1 << 30))
+        rule = CgroupRule(80)
+        rule(Proc(), system)
+        write("proc/10/cgroup", "0::/batch.slice\n")
+        system = SystemSample(system.timestamp + 1, 10, None)
+        assert rule(Proc(), system) is None
+        system = SystemSample(system.timestamp + 1, 10, None)
+        rule(Proc(), system)
+        assert list(rule._groups) == ["/batch.slice"]
+        assert Cgroup("/batch.slice").procs() == []
+
+        Proc.pid = 11
+        assert rule(Proc(), system) is None
+        with pytest.raises(UnfoundException):
+            Cgroup.of_pid(11)
+        with pytest.raises(UnfoundException):
+            Cgroup("/no/such/group")
+    finally:
+        pps.CGROUP_ROOT, pps.PROC_ROOT = old_roots
+
+def test_watcher():
+    killed = []
+    exited = []
+    watcher = Watcher([os.getpid(), 1], interval=0.01,
+                      rules=[lambda p, system: p.pid == os.getpid() and "test"],
+                      action=lambda p, reason: killed.append((p.pid, reason)),
+                      on_exit=exited.append)
+    watcher.run(ticks=3)
+    assert killed == [(os.getpid(), "test")]
+    watcher.close()
+    assert list(watcher.processes) == [1]
+    assert watcher.ticks == 3
+    assert watcher.max_lag >= 0
+    assert 0 <= watcher.system.mem_percent <= 100
+    assert exited == []
+
+def test_watcher_faulty_rules():
+    def rule(p, system):
+        if p.pid == 1:
+            raise PermissionError("denied")
+        raise UnfoundException("exited")
+
+    def action(p, reason):
+        raise PermissionError("denied")
+
+    exited = []
+    watcher = Watcher([os.getpid(), 1], rules=[rule], action=action,
+                      on_exit=exited.append)
+    assert watcher.tick() == []
+    assert exited == [os.getpid()] and list(watcher.processes) == [1]
+    watcher.rules = [lambda p, system: "test"]
+    assert len(watcher.tick()) == 1 and not watcher.processes
+
+def test_ring_buffer():
+    buf = RingBuffer(3)
+    assert buf.last() == []
+    for i in range(5):
+        buf.append(i)
+    assert len(buf) == 3
+    assert buf.last() == [2, 3, 4]
+    assert buf.last(2) == [3, 4]
+    assert buf[0] == 2 and buf[-1] == 4
+
+def test_history():
+    class Sample(object):
+        def __init__(self, rss, ident=(1, 0)):
+            self.pid, self.ident = 1, ident
+            self.mem, self.rss = 0.0, rss
+
+        def cpu_percent(self):
+            return 0.0
+
+    history = History(size=100)
+    for t in range(60):
+        history.record(Sample(1000 + t * 10), timestamp=t)
+    assert history.max(1, "rss") == 1590
+    assert history.mean(1, "rss", seconds=10) == 1540
+    assert history.percentile(1, "rss", 50) == 1295
+    assert history.rate(1, "rss", seconds=30) == 10
+    assert history.duration_above(1, "rss", 1500) == 8
+    assert SustainedRule(history, "rss", 1500, 5)(Sample(0), None)
+    assert not SustainedRule(history, "rss", 1500, 30)(Sample(0), None)
+    assert GrowthRule(history, "rss", 500, window=30)(Sample(0), None)
+    assert not GrowthRule(history, "rss", 700, window=30)(Sample(0), None)
+
+    history.record(Sample(1, ident=(1, 5)), timestamp=60)
+    assert history.max(1, "rss") == 1
+    history.forget(1)
+    assert 1 not in history
+
+    watcher = Watcher([os.getpid()], interval=0.01, history=History(), rules=[])
+    watcher.run(ticks=2)
+    assert len(watcher.history.window(os.getpid(), "rss")[1]) == 2
+
+def test_async_api():
+    import asyncio
+
+    async def collect():
+        p = Process(os.getpid())
+        await p.aupdate()
+        pids = [q.pid async for q in aprocesses()]
+        snap = await asnapshot()
+        percent = await acpu_percent(0.01)
+        watcher = Watcher([os.getpid()], interval=0.01, rules=[])
+        await watcher.arun(ticks=2)
+        return p, pids, snap, percent, watcher
+
+    p, pids, snap, percent, watcher = asyncio.run(collect())
+    assert p.cmd
+    assert os.getpid() in pids
+    assert os.getpid() in snap
+    assert 0 <= percent <= 100
+    assert watcher.ticks == 2
+
+def test_process_update_static_fields():
+    p = Process(os.getpid())
+    cmd = p.cmd
+    p.cmd = "changed"
+    p.update()
+    assert p.cmd == "changed"
+    p.update(full=True)
+    assert p.cmd == cmd
+    assert p.ident[0] == os.getpid()
+
+def test_process_cache():
+    cache = ProcessCache(maxsize=2)
+    p = cache.get(os.getpid())
+    assert cache.get(os.getpid()) is p
+    assert cache.hits == 1 and cache.misses == 1
+    cache.get(1)
+    cache.get(os.getppid())
+    assert len(cache) == 2
+    assert os.getpid() not in cache
+    assert cache.evicted == 1
+
+    cache = ProcessCache(ttl=60)
+    snap = cache.scan()
+    assert len(cache) == len(snap)
+    cache.scan()
+    assert cache.hits >= len(snap) - 2
+
+def test_process_cache_pid_reused():
+    cache = ProcessCache()
+    p = cache.get(os.getpid())
+    p._starttime -= 1  # as if the pid belonged to an older process
+    assert cache.get(os.getpid()) is not p
+    assert cache.reused == 1
+
+def test_fake_proc_snapshot(tmpdir):
+    with fake_proc(str(tmpdir), 200) as pids:
+        snap = snapshot()
+        assert sorted(snap.pids()) == sorted(pids)
+        assert snap.vanished == 0
+        table = ProcessTable.scan()
+        assert sorted(table["pid"]) == sorted(pids)
+        assert 0 < mem_percent() < 100
+
+def test_processes_filters():
+    import re
+    me = Process(os.getpid())
+    pids = [p.pid for p in processes(user=me.user, cmd_re=re.escape(me.cmd))]
+    assert os.getpid() in pids
+    assert list(processes(user="no-such-user")) == []
+
+def test_snapshot_diff(tmpdir):
+    with fake_proc(str(tmpdir), 20) as pids:
+        before = snapshot()
+        root = str(tmpdir)
+        # pid 1 exits, pids[1] is reused by a new process, pids[2] grows
+        shutil.rmtree(os.path.join(root, "1"))
+        for pid, old, new in ((pids[1], 0, 1), (pids[2], None, None)):
+            path = os.path.join(root, str(pid), "stat")
+            with open(path) as f:
+                fields = f.read().split()
+            if old is None:
+                fields[23] = str(int(fields[23]) + 10240)  # rss in pages
+            else:
+                fields[21] = str(int(fields[21]) + 1)  # starttime
+            with open(path, "w") as f:
+                f.write(" ".join(fields) + "\n")
+        diff = before.diff(before)
+        assert not diff
+        diff = snapshot().diff(before)
+
+    assert [p.pid for p in diff.spawned] == [pids[1]]
+    assert sorted(p.pid for p in diff.exited) == [1, pids[1]]
+    (p, previous), = diff.changed
+    assert p.pid == pids[2] and p.rss - previous["rss"] == 40960
+
+def test_snapshot_diff_cache(tmpdir):
+    with fake_proc(str(tmpdir), 20) as pids:
+        cache = ProcessCache()
+        before = cache.scan()
+        path = os.path.join(str(tmpdir), str(pids[2]), "stat")
+        with open(path) as f:
+            fields = f.read().split()
+        fields[23] = str(int(fields[23]) + 10240)
+        with open(path, "w") as f:
+            f.write(" ".join(fields) + "\n")
+        after = cache.scan()
+        assert after.processes == before.processes
+        cpu_recent = [p._cpu_recent for p in after]
+        (p, previous), = after.diff(before).changed
+        assert [p._cpu_recent for p in after] == cpu_recent
+        assert p.pid == pids[2] and p.rss - previous["rss"] == 40960
+        with pytest.raises(ValueError):
+            after.diff(before, {"cmd": None})
+
+def test_watch_changes():
+    import subprocess
+    changes = watch_changes(interval=0.05, thresholds={"stat": None})
+    first = next(changes)
+    assert os.getpid() in [p.pid for p in first.spawned]
+    child = subprocess.Popen(["sleep", "5"])
+    try:
+        diff = next(changes)
+        assert child.pid in [p.pid for p in diff.spawned]
+    finally:
+        child.kill()
+        child.wait()
+    diff = next(changes)
+    assert child.pid in [p.pid for p in diff.exited]
+
+def test_scanner(tmpdir):
+    with fake_proc(str(tmpdir), 300) as pids:
+        serial = [(p.pid, p.cmd, p.rss) for p in snapshot()]
+        for use_processes in (False, True):
+            with Scanner(workers=3, threshold=100, use_processes=use_processes) as scanner:
+                snap = scanner.snapshot()
+            assert [(p.pid, p.cmd, p.rss) for p in snap] == serial
+            assert sorted(snap.pids()) == pids
+        with Scanner(workers=3, threshold=1000) as scanner:
+            assert len(scanner.snapshot()) == 300
+            assert scanner._pool is None
+
+def test_processes_filters_fake_proc(tmpdir):
+    with fake_proc(str(tmpdir), 300):
+        all_procs = list(processes())
+        nginx = [p.pid for p in all_procs if p.cmd.startswith("/usr/bin/nginx ")]
+        assert sorted(p.pid for p in processes(name="nginx")) == sorted(nginx)
+        big = [p.pid for p in all_procs if p.rss >= 100000]
+        assert sorted(p.pid for p in processes(min_rss=100000)) == sorted(big)
+        odd = [p.pid for p in processes(predicate=lambda p: p.pid % 2)]
+        assert all(pid % 2 for pid in odd)
+        worker7 = [p.pid for p in all_procs if p.cmd.endswith("--worker 7")]
+        assert [p.pid for p in processes(cmd_re=r"--worker 7$")] == worker7
+
+def test_instrument(tmpdir):
+    update, read = Process.update, pps._read
+    spans = []
+    with fake_proc(str(tmpdir), 50) as pids:
+        with open(os.path.join(str(tmpdir), str(pids[1]), "stat"), "w") as f:
+            f.write("garbage")
+        stats = instrument(hook=lambda *span: spans.append(span))
+        try:
+            assert pps.stats() is stats and Process.update is not update
+            assert len(list(processes())) == 49
+            p = Process(pids[2])
+            p.update()
+            shutil.rmtree(os.path.join(str(tmpdir), str(pids[2])))
+            with pytest.raises(UnfoundException):
+                p.update()
+            pps.mem_percent()
+            assert len(pps.snapshot()) == 48
+            with Scanner(workers=2, threshold=10, use_processes=True) as scanner:
+                assert len(scanner.snapshot()) == 48
+        finally:
+            assert uninstrument() is stats
+    assert Process.update is update and pps._read is read
+    assert pps.stats() is None
+
+    assert stats.ops["processes.read"].count == 50
+    # The update of the constructor is not timed
+    assert stats.ops["Process.update"].count == 2
+    assert stats.ops["snapshot"].count == 1
+    # processes(), snapshot() and the scanner each skip the garbage stat
+    assert stats.parse_errors == 3 and stats.vanished == 1
+    assert [(op, pid) for op, pid, err in stats.errors] == [
+        ("processes.read", pids[1]), ("Process.update", pids[2])]
+    assert stats.reads > 150 and stats.read_bytes > stats.reads * 50
+    assert len(stats.slowest) == 10
+    assert all(op in ("processes.read", "Process.update") for _, op, _ in stats.slowest)
+    hist = stats.ops["processes.read"]
+    assert hist.min <= hist.percentile(50) <= hist.percentile(99) <= hist.max
+    assert len(spans) == 55 and spans[-1][:2] == ("Scanner.snapshot", None)
+    assert stats.to_dict()["parse_errors"] == 3
+
+def test_instrument_vanished(tmpdir):
+    with fake_proc(str(tmpdir), 10) as pids:
+        cache = ProcessCache()
+        cache.get(pids[0])
+        with open(os.path.join(str(tmpdir), str(pids[1]), "stat"), "w") as f:
+            f.write("garbage")
+        stats = instrument()
+        try:
+            shutil.rmtree(os.path.join(str(tmpdir), str(pids[0])))
+            with pytest.raises(UnfoundException):
+                cache.get(pids[0])
+            assert len(cache.scan()) == 8
+        finally:
+            uninstrument()
+    assert stats.vanished == 1 and stats.parse_errors == 1
+    assert stats.ops["Process.update"].count == 1
+
+def test_scan_unparsed(tmpdir):
+    with fake_proc(str(tmpdir), 30) as pids:
+        with open(os.path.join(str(tmpdir), str(pids[3]), "stat"), "w") as f:
+            f.write("garbage")
+        snap = pps.snapshot()
+        assert len(snap) == 29 and snap.unparsed == 1 and pids[3] not in snap
+        with Scanner(workers=2, threshold=10) as scanner:
+            assert scanner.snapshot().unparsed == 1
+        table = ProcessTable.scan()
+        assert len(table) == 29 and table.unparsed == 1
+        cache = ProcessCache()
+        assert cache.scan().unparsed == 1 and pids[3] not in cache
+        assert len(ProcessTree.scan().subtree(pids[0])) >= 1
+        diff = next(pps.watch_changes(interval=0, ticks=1))
+        assert len(diff.spawned) == 29
+
+def test_processes_loaded(tmpdir):
+    with fake_proc(str(tmpdir), 10) as pids:
+        procs = list(processes(min_rss=0))
+        for p in procs:
+            shutil.rmtree(os.path.join(str(tmpdir), str(p.pid)))
+        assert sorted(p.pid for p in procs) == pids
+        assert all(p.cmd.startswith("/usr/bin/") and p.user for p in procs)
+        assert len(set(str(p) for p in procs)) == 10
+
+def test_processes_filter_errors(tmpdir):
+    with fake_proc(str(tmpdir), 30) as pids:
+        # The fake directories are owned by root, as those of non-dumpable
+        # processes are, so the user is checked against the status
+        nobody = [p.pid for p in processes() if p.user == "nobody"]
+        assert nobody and [p.pid for p in processes(user="nobody")] == nobody
+        with pytest.raises(AttributeError):
+            list(processes(predicate=lambda p: p.nonexistent))
+        with open(os.path.join(str(tmpdir), str(pids[0]), "stat"), "w") as f:
+            f.write("garbage")
+        assert len(list(processes())) == 29
+
+def test_process_smaps(tmpdir):
+    with fake_proc(str(tmpdir), 10) as pids:
+        p = Process(pids[3])
+        rss = p.rss
+        assert p._loaded & pps.SMAPS == 0
+        assert (p.pss, p.uss, p.swap, p.swap_pss) == (rss // 4 * 3, rss // 2, 0, 0)
+
+        path = os.path.join(str(tmpdir), str(p.pid), "smaps_rollup")
+        with open(path) as f:
+            data = f.read()
+        with open(path, "w") as f:
+            f.write(data.replace("Pss:            %d kB" % p.pss, "Pss:            1 kB"))
+        p.update()
+        assert p.pss == rss // 4 * 3  # younger than SMAPS_MAX_AGE
+        p.refresh("smaps")
+        assert p.pss == 1
+
+        system = SystemSample(time.time(), 95, None)
+        p.mem = 60
+        assert MemRule(50)(p, system) == "mem 60.0% > 50%"
+        assert MemRule(50, accurate=True)(p, system) is None
+        p.mem = 40
+        p._extra.smaps_at = None
+        assert MemRule(50, accurate=True)(p, system) is None
+        assert p.smaps_age() is None  # the rss check ruled it out
+
+def test_process_threads():
+    import threading
+    stop = threading.Event()
+    tids = []
+
+    def spin():
+        tids.append(threading.get_native_id())
+        while not stop.is_set():
+            pass
+
+    p = Process(os.getpid())
+    thread = threading.Thread(target=spin)
+    thread.start()
+    try:
+        p.threads()
+        time.sleep(0.3)
+        top = p.top_threads(1)
+    finally:
+        stop.set()
+        thread.join()
+    assert top[0].tid == tids[0]
+    assert top[0].cpu_percent > 10
+    assert top[0].state in "RS"
+    assert os.getpid() in [t.tid for t in p.threads()]
+
+def test_process_threads_fake_proc(tmpdir):
+    with fake_proc(str(tmpdir), 5) as pids:
+        p = Process(pids[2])
+        main, = p.threads()
+        assert (main.tid, main.name) == (p.pid, p._comm)
+        assert main.cpu_percent == p.cpu
+
+        task = os.path.join(str(tmpdir), str(p.pid), "task")
+        with open(os.path.join(task, str(p.pid), "stat")) as f:
+            fields = f.read().split()
+        fields[0], fields[1], fields[13] = "99999", "(worker)", str(int(fields[13]) + 100)
+        os.mkdir(os.path.join(task, "99999"))
+        with open(os.path.join(task, "99999", "stat"), "w") as f:
+            f.write(" ".join(fields))
+        p._extra.threads_at -= 1  # one second since the first call
+        threads = dict((t.tid, t) for t in p.threads())
+        assert threads[99999].name == "worker"
+        assert threads[p.pid].cpu_percent == 0
+
+def test_process_rates(tmpdir):
+    with fake_proc(str(tmpdir), 5) as pids:
+        watcher = Watcher([pids[1]], interval=0.01, rules=[
+            RateRule("write_rate", 1 << 20), RateRule("nonvoluntary_ctxt_rate", 1000)])
+        p = watcher.processes[pids[1]]
+        assert p._loaded & (pps.IO | pps.CTXT) == pps.IO | pps.CTXT
+        assert p.write_rate is None and p.voluntary_ctxt is not None
+
+        piddir = os.path.join(str(tmpdir), str(p.pid))
+        with open(os.path.join(piddir, "io")) as f:
+            io = f.read()
+        with open(os.path.join(piddir, "io"), "w") as f:
+            f.write(io.replace("write_bytes: %d" % p.write_bytes,
+                               "write_bytes: %d" % (p.write_bytes + 1000)))
+        p._extra.io_at -= 1  # one second since the first read
+        p._extra.ctxt_at -= 1
+        reads = []
+        read = pps._read
+        pps._read = lambda path: reads.append(path) or read(path)
+        try:
+            assert watcher.tick() == []
+        finally:
+            pps._read = read
+        assert p.write_rate == pytest.approx(1000, rel=0.01)
+        assert p.read_rate == 0 and p.nonvoluntary_ctxt_rate == 0
+        assert sorted(os.path.basename(path) for path in reads
+                      if "/%d/" % p.pid in path) == ["io", "stat", "status"]
+
+        rule = RateRule("write_rate", 500)
+        assert rule.groups == ["io"]
+        assert rule(p, None).startswith("write_rate 99")
+        with pytest.raises(ValueError):
+            RateRule("rss", 1)
+
+def test_process_extra():
+    p = Process(os.getpid())
+    assert p._extra is None and p.start and p.time
+    assert p.read_rate is None and p._extra is None
+    p.refresh("io")
+    assert p._extra is not None and p.read_bytes is not None
+
+def test_lazy_process():
+    reads = []
+    read = pps._read
+    pps._read = lambda path: reads.append(os.path.basename(path)) or read(path)
+    try:
+        p = Process(os.getpid(), lazy=True)
+        assert reads == []
+        assert p.rss > 0
+        assert reads == ["stat"]
+        assert p.vsz > 0 and p.cpu >= 0
+        assert reads == ["stat"]
+        assert p.user
+        assert reads == ["stat", "status"]
+        p.refresh("stat")
+        assert reads == ["stat", "status", "stat"]
+        assert p.read_bytes is None or p.read_bytes >= 0
+        assert reads[-1] == "io"
+    finally:
+        pps._read = read
+    assert not hasattr(p, "__dict__")
+
+def test_process_tree():
+    tree = ProcessTree.scan()
+    me = os.getpid()
+    assert tree.get(me).ppid == os.getppid()
+    assert os.getppid() in [p.pid for p in tree.ancestors(me)]
+    assert me in [p.pid for p in tree.descendants(tree.ancestors(me)[-1].pid)]
+    sums = tree.subtree_sum(os.getppid())
+    assert sums["rss"] >= tree.get(me).rss
+    tree.refresh()
+    assert me in tree
+
+def test_process_tree_update(tmpdir):
+    with fake_proc(str(tmpdir), 100) as pids:
+        tree = ProcessTree(snapshot())
+        assert [p.pid for p in tree.roots()] == [1]
+        assert len(tree.descendants(1)) == 99
+        total = sum(p.rss for p in snapshot())
+        assert tree.subtree_sum(1, fields=("rss",)) == {"rss": total}
+
+        leaf = [pid for pid in pids if not tree.children(pid)][0]
+        parent = tree.get(leaf).ppid
+        import shutil
+        shutil.rmtree(os.path.join(str(tmpdir), str(leaf)))
+        tree.update(snapshot())
+        assert leaf not in tree
+        assert leaf not in [p.pid for p in tree.children(parent)]
+        assert len(tree.descendants(1)) == 98
+
+def _check_kill():
+    import subprocess
+    import sys
+    child = subprocess.Popen(["sleep", "30"])
+    p = Process(child.pid)
+    assert not p.wait_exit(timeout=0.05)
+    elapsed = p.kill(timeout=5)
+    assert elapsed is not None and elapsed < 5
+    assert child.wait() == -15
+    assert p.kill() == 0.0
+
+    code = ("import signal, sys, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); "
+            "sys.stdout.write('ready\\n'); sys.stdout.flush(); time.sleep(30)")
+    child = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+    child.stdout.readline()
+    p = Process(child.pid)
+    assert p.kill(timeout=0.2, escalate=False) is None
+    elapsed = p.kill(timeout=0.2)
+    assert elapsed is not None and elapsed >= 0.2
+    assert child.wait() == -9
+    child.stdout.close()
+
+def test_kill():
+    _check_kill()
+
+def test_kill_without_pidfd():
+    pidfd_open = pps._pidfd_open
+    pps._pidfd_open = lambda pid: None
+    try:
+        _check_kill()
+    finally:
+        pps._pidfd_open = pidfd_open
+
+def test_kill_without_permission(monkeypatch):
+    def send_signal(pid, pidfd, sig):
+        raise PermissionError("denied")
+    monkeypatch.setattr(pps, "_send_signal", send_signal)
+    assert Process(os.getpid()).kill() is None